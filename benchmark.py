@@ -0,0 +1,186 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import pandas as pd
+
+import mock_arcgis
+import utils
+
+
+# throughput benchmark of the update functions against the in-process mock service
+# reports the requests issued, the wall time and the peak memory of each workload
+#
+#   python benchmark.py --sizes 1000 10000 100000 --latency 0.05 --workers 4
+
+
+def make_rows(size, seed=0):
+    # rows of the hosted layer with a square polygon each
+    rng = random.Random(seed)
+    rows = []
+    for i in range(size):
+        x, y = i % 1000, i // 1000
+        rows.append({'Identifier': f'ID{i:07d}',
+                     'EditDate': 1500000000000,
+                     'Name': f'name {rng.randint(0, 50)}',
+                     'Class': rng.randint(1, 4),
+                     'activity': f'activity {rng.randint(0, 20)}',
+                     'FASCIA': f'fascia {rng.randint(0, 50)}',
+                     'ACTIVITY': f'activity {rng.randint(0, 20)}',
+                     'USE_CLASS': f'class {rng.randint(0, 10)}',
+                     'geometry': {'rings': [[[x, y], [x, y + 1], [x + 1, y + 1], [x + 1, y], [x, y]]]}})
+    return rows
+
+
+def make_update_df(rows, change_rate, seed=1):
+    # csv like frame of the rows with a share of the values changed and a survey newer than the last edit
+    rng = random.Random(seed)
+    df = pd.DataFrame([{k: v for k, v in row.items() if k != 'geometry'} for row in rows])
+    changed = [rng.random() < change_rate for _ in range(len(df))]
+    for col in ['Name', 'activity', 'FASCIA', 'ACTIVITY', 'USE_CLASS']:
+        df.loc[changed, col] = df.loc[changed, col] + ' changed'
+    df['DATE_UNIX'] = 1600000000
+    return df.drop(columns=['EditDate'])
+
+
+def make_geojson(rows, change_rate, seed=2):
+    # Geojson features of the rows with a share of the shapes moved
+    rng = random.Random(seed)
+    features = []
+    for row in rows:
+        rings = row['geometry']['rings']
+        if rng.random() < change_rate:
+            rings = [[[x + 0.5, y] for x, y in ring] for ring in rings]
+        features.append({'type': 'Feature',
+                         'properties': {'Identifier': row['Identifier']},
+                         'geometry': {'type': 'Polygon', 'coordinates': rings}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def make_view_sources(folder, view_count):
+    # zipped shapefile with one column per view and the csv of the column hierarchy
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    codes = [f'C{i:03d}' for i in range(view_count)]
+    gdf = gpd.GeoDataFrame({code: [1] for code in codes}, geometry=[box(0, 0, 1, 1)], crs='EPSG:4326')
+    shp_folder = os.path.join(folder, 'views')
+    os.makedirs(shp_folder, exist_ok=True)
+    gdf.to_file(os.path.join(shp_folder, 'views.shp'))
+    zip_location = os.path.join(folder, 'views.zip')
+    with zipfile.ZipFile(zip_location, 'w') as zip_file:
+        for file_name in os.listdir(shp_folder):
+            zip_file.write(os.path.join(shp_folder, file_name), file_name)
+
+    csv_location = os.path.join(folder, 'views.csv')
+    pd.DataFrame({'Name': [f'Colour Bin {code} name' for code in codes],
+                  'New_Code': codes,
+                  'Order': range(view_count),
+                  'has_view': 'yes',
+                  'Group': 'group',
+                  'SubGroup': 'subgroup'}).to_csv(csv_location, index=False)
+    return zip_location, csv_location
+
+
+def run_workload(name, size, service_options, rows, func, verbose=False):
+    # publish the rows on a fresh mock service, then run one workload on it and measure it
+    service = mock_arcgis.MockService(**service_options)
+    gis = mock_arcgis.MockGIS(service)
+    session = mock_arcgis.MockSession(gis)
+    item = gis.add_layer_item('layer', rows)
+    service.reset()
+    utils.retry_policy.reset()
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output) if not verbose else contextlib.nullcontext():
+        func(item, session)
+    wall_time = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    counters = dict(service.counters)
+    return {'workload': name,
+            'size': size,
+            'requests': counters.get('requests', 0),
+            'edit_requests': counters.get('edit_features', 0),
+            'query_requests': counters.get('query', 0),
+            'throttled': counters.get('throttled', 0),
+            'failed': counters.get('failed', 0),
+            'bytes_sent': counters.get('bytes_sent', 0),
+            'wall_time': round(wall_time, 3),
+            'peak_memory_mb': round(peak / 2 ** 20, 1)}
+
+
+def benchmark(sizes, chunk_size, workers, change_rate, service_options, view_count, verbose=False):
+    results = []
+    for size in sizes:
+        rows = make_rows(size)
+        update_df = make_update_df(rows, change_rate)
+        geojson = make_geojson(rows, change_rate)
+
+        results.append(run_workload('update_all', size, service_options, rows, lambda item, session: utils.update_all(
+            item.collection, update_df, chunk_size=chunk_size, max_workers=workers), verbose))
+        results.append(run_workload('update_new_survey', size, service_options, rows, lambda item, session: utils.update_new_survey(
+            item.collection, update_df, chunk_size=chunk_size, max_workers=workers), verbose))
+        results.append(run_workload('update_geometry', size, service_options, rows, lambda item, session: utils.update_geometry(
+            geojson, item.collection, chunk_size=chunk_size, max_workers=workers), verbose))
+        results.append(run_workload('upsert_features', size, service_options, rows, lambda item, session: utils.upsert_features(
+            item.collection, update_df, session=session), verbose))
+
+    if view_count:
+        with tempfile.TemporaryDirectory() as folder:
+            zip_location, csv_location = make_view_sources(folder, view_count)
+            results.append(run_workload('create_views_columns', view_count, service_options, [], lambda item, session: utils.create_views_columns(
+                zip_location, csv_location, item, max_workers=workers, session=session), verbose))
+    return results
+
+
+def print_results(results):
+    columns = ['workload', 'size', 'requests', 'edit_requests', 'query_requests', 'throttled', 'failed', 'bytes_sent', 'wall_time', 'peak_memory_mb']
+    print(pd.DataFrame(results, columns=columns).to_string(index=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the update functions against an in-process mock feature service')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--change-rate', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--failure-rate', type=float, default=0, help='share of requests failing with a transient error')
+    parser.add_argument('--feature-failure-rate', type=float, default=0, help='share of edited features rejected')
+    parser.add_argument('--max-requests-per-second', type=float, default=None, help='throttle above this rate')
+    parser.add_argument('--views', type=int, default=0, help='number of views for create_views_columns, 0 to skip')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    log_folder = tempfile.mkdtemp()
+    utils.setup_logging(os.path.join(log_folder, 'benchmark_log.txt'))
+    # retry quickly against the mock service
+    utils.retry_policy = utils.RetryPolicy(base_delay=0.01, max_delay=0.2)
+
+    service_options = {'latency': args.latency,
+                       'failure_rate': args.failure_rate,
+                       'feature_failure_rate': args.feature_failure_rate,
+                       'max_requests_per_second': args.max_requests_per_second,
+                       'seed': 0}
+    results = benchmark(args.sizes, args.chunk_size, args.workers, args.change_rate, service_options, args.views, args.verbose)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import argparse
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import utils
+
+
+# run the updates of many layers in parallel processes from a manifest, with one budget of requests in flight
+# shared by all of them, and report one summary
+#
+# manifest (json, or yaml if PyYAML is installed):
+# {
+#     "max_processes": 4,
+#     "max_requests_in_flight": 16,
+#     "defaults": {"id_col": "Identifier", "chunk_size": 1000},
+#     "jobs": [
+#         {"name": "shops", "layer": "Shops survey", "mode": "update_new_survey",
+#          "source": "data/shops.csv", "update_cols": ["FASCIA", "ACTIVITY", "USE_CLASS"]},
+#         {"name": "parcels", "item_id": "0123456789abcdef", "mode": "update_geometry", "source": "data/parcels.shp"}
+#     ]
+# }
+#
+# layer is a search text as used by find_feature, item_id selects the layer item directly
+# source is a csv, parquet or arrow file for update_all, update_new_survey and upsert, only the id and update columns are read
+# checkpoint is a sqlite journal file, a job rerun after a crash skips the ids it already applied
+#
+#   python jobs.py manifest.json --summary Logs/summary.json
+
+MODES = ['update_all', 'update_new_survey', 'update_geometry', 'upsert']
+JOB_KEYS = ['name', 'layer', 'item_id', 'mode', 'source', 'id_col', 'update_cols', 'chunk_size', 'max_workers', 'checkpoint', 'options']
+
+
+def load_manifest(manifest_file):
+    # read a json or yaml manifest
+    with open(manifest_file, 'r') as manifest_object:
+        if manifest_file.lower().endswith(('.yml', '.yaml')):
+            import yaml
+            return yaml.safe_load(manifest_object)
+        return json.load(manifest_object)
+
+
+def make_jobs(manifest):
+    # apply the defaults to every job and check them all before anything runs
+    defaults = manifest.get('defaults', {})
+    jobs, problems = [], []
+    for job_index, job in enumerate(manifest.get('jobs', [])):
+        job = dict(defaults, **job)
+        name = job.setdefault('name', f"job {job_index + 1}")
+        job.setdefault('id_col', 'Identifier')
+        job.setdefault('options', {})
+        if job.get('mode') not in MODES:
+            problems.append(f"{name}: mode should be one of {MODES}, got {job.get('mode')}")
+        if not job.get('layer') and not job.get('item_id'):
+            problems.append(f"{name}: layer or item_id is required")
+        if not job.get('source'):
+            problems.append(f"{name}: source is required")
+        if job.get('mode') in ['update_all', 'update_new_survey', 'upsert'] and not job.get('update_cols'):
+            problems.append(f"{name}: update_cols is required for {job.get('mode')}")
+        unknown = set(job) - set(JOB_KEYS)
+        if unknown:
+            problems.append(f"{name}: unknown keys {sorted(unknown)}")
+        jobs.append(job)
+    names = [x['name'] for x in jobs]
+    if len(set(names)) != len(names):
+        problems.append(f"job names should be unique, got {names}")
+    if problems:
+        raise ValueError("Manifest problems:\n" + "\n".join(problems))
+    return jobs
+
+
+def init_worker(semaphore, log_folder, metrics_file=None):
+    # each process shares the request budget and logs to its own files
+    utils.set_request_budget(semaphore)
+    utils.setup_logging(os.path.join(log_folder, f"update_log_{os.getpid()}.txt"),
+                        os.path.join(log_folder, f"update_events_{os.getpid()}.jsonl"), metrics_file)
+    # pool processes exit without running atexit, write the queued log records on exit anyway
+    multiprocessing.util.Finalize(None, utils.stop_logging, exitpriority=10)
+
+
+def find_layer(job, session):
+    if job.get('item_id'):
+        return session.layer_collection(job['item_id'])
+    return utils.find_feature(job['layer'], session=session)
+
+
+def run_job(job, max_workers, session=None):
+    # run one job and return its summary, errors are reported instead of raised
+    start_time = time.time()
+    summary = {'name': job['name'], 'mode': job['mode'], 'source': job['source'], 'status': 'ok'}
+    checkpoint = None
+    try:
+        session = session or utils.get_session()
+        lyr = find_layer(job, session)
+        options = dict(job['options'], id_col=job['id_col'], max_workers=job.get('max_workers') or max_workers)
+        if job.get('chunk_size'):
+            options['chunk_size'] = job['chunk_size']
+        if job.get('checkpoint'):
+            checkpoint = utils.CheckpointJournal(job['checkpoint'], job['name'], job['source'])
+            options['checkpoint'] = checkpoint
+
+        if job['mode'] == 'update_all':
+            csv_df = utils.read_update_csv(job['source'], job['id_col'], job['update_cols'], date_col=None)
+            report = utils.update_all(lyr, csv_df, list_of_update_col=job['update_cols'], **options)
+        elif job['mode'] == 'update_new_survey':
+            csv_df = utils.read_update_csv(job['source'], job['id_col'], job['update_cols'])
+            report = utils.update_new_survey(lyr, csv_df, list_of_update_col=job['update_cols'], **options)
+        elif job['mode'] == 'upsert':
+            csv_df = utils.read_update_csv(job['source'], job['id_col'], job['update_cols'], date_col=None)
+            report = utils.upsert_features(lyr, csv_df, list_of_update_col=job['update_cols'], session=session, **options)
+        else:
+            report = utils.update_geometry(job['source'], lyr, **options)
+
+        for key in ['updated', 'added', 'failed', 'missing', 'unchanged', 'empty']:
+            if key in report:
+                summary[key] = len(report[key])
+        if 'skipped' in report:
+            summary['skipped'] = report['skipped']
+        summary['failed_ids'] = [x['id'] for x in report.get('failed', [])]
+        summary['retries'] = (report.get('metrics') or {}).get('retries', utils.retry_policy.summary())
+        summary['metrics'] = report.get('metrics')
+        if summary.get('failed'):
+            summary['status'] = 'partial'
+    except Exception as error:
+        summary['status'] = 'error'
+        summary['error'] = str(error)
+        utils.logger.debug(traceback.format_exc())
+    finally:
+        # a job which raised did not finish its run, so its counters must not leak into the next job of the process
+        if checkpoint is not None:
+            checkpoint.close()
+        utils.retry_policy.reset()
+        utils.metrics.reset()
+    summary['seconds'] = round(time.time() - start_time, 1)
+    return summary
+
+
+def run_jobs(manifest, max_processes=None, max_requests_in_flight=None, log_folder='Logs', session=None, metrics_file=None):
+    # run the jobs of the manifest in parallel processes and return their summaries in manifest order
+    # max_processes 0 runs the jobs one after the other in this process, using session if given
+    # metrics_file collects the timing summary of every job as json lines
+    jobs = make_jobs(manifest)
+    max_processes = manifest.get('max_processes', 4) if max_processes is None else max_processes
+    max_requests_in_flight = max_requests_in_flight or manifest.get('max_requests_in_flight', 16)
+    # each process gets an even share of the budget as its number of edit workers
+    max_workers = max(1, max_requests_in_flight // max(1, min(max_processes, len(jobs))))
+    utils.print_text_log(f"Running {len(jobs)} jobs in {max_processes or 'this'} process{'es' if max_processes else ''} with {max_requests_in_flight} requests in flight")
+
+    summaries = {}
+    if metrics_file is not None:
+        utils.setup_logging(metrics_file=metrics_file)
+    if max_processes == 0:
+        for job in jobs:
+            summaries[job['name']] = run_job(job, max_workers, session)
+    else:
+        os.makedirs(log_folder, exist_ok=True)
+        context = multiprocessing.get_context()
+        semaphore = context.BoundedSemaphore(max_requests_in_flight)
+        with ProcessPoolExecutor(max_workers=max_processes, mp_context=context,
+                                 initializer=init_worker, initargs=(semaphore, log_folder, metrics_file)) as executor:
+            futures = {executor.submit(run_job, job, max_workers): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    summaries[job['name']] = future.result()
+                except Exception as error:
+                    summaries[job['name']] = {'name': job['name'], 'mode': job['mode'], 'source': job['source'],
+                                              'status': 'error', 'error': str(error)}
+                utils.print_text_log(f"Job {job['name']} finished with status {summaries[job['name']]['status']}")
+
+    return [summaries[job['name']] for job in jobs]
+
+
+def print_summary(summaries):
+    columns = ['name', 'mode', 'status', 'updated', 'added', 'failed', 'skipped', 'unchanged', 'missing', 'empty', 'seconds', 'error']
+    frame = pd.DataFrame(summaries, dtype=object).reindex(columns=columns)
+    utils.print_text_log(frame.where(frame.notna(), '').to_string(index=False))
+    counts = frame['status'].value_counts().to_dict()
+    utils.print_text_log(f"{len(summaries)} jobs: {counts.get('ok', 0)} ok, {counts.get('partial', 0)} partial, {counts.get('error', 0)} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the layer updates of a manifest in parallel')
+    parser.add_argument('manifest')
+    parser.add_argument('--processes', type=int, default=None, help='overrides max_processes of the manifest')
+    parser.add_argument('--requests', type=int, default=None, help='overrides max_requests_in_flight of the manifest')
+    parser.add_argument('--summary', help='write the summary as json to this file')
+    parser.add_argument('--metrics', help='append the timing summary of every job as json lines to this file')
+    args = parser.parse_args()
+
+    summaries = run_jobs(load_manifest(args.manifest), args.processes, args.requests, metrics_file=args.metrics)
+    print_summary(summaries)
+    if args.summary:
+        with open(args.summary, 'w') as summary_file:
+            json.dump(summaries, summary_file, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+import collections
+import copy
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+import utils
+
+
+# in-process stand-in for the parts of the ArcGIS API used by utils, to measure and check the update functions offline
+
+
+class PropertyMap(dict):
+    # dict with attribute access like the properties of the ArcGIS API
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class MockFeature:
+    def __init__(self, attributes, geometry=None):
+        self.attributes = attributes
+        self.geometry = geometry
+
+
+class MockFeatureSet:
+    def __init__(self, features, exceeded_transfer_limit=False):
+        self.features = features
+        self.exceeded_transfer_limit = exceeded_transfer_limit
+
+
+class MockService:
+    # shared behaviour of the mock service: latency, failures, throttling and request counters
+    # latency is seconds per request, failure_rate the share of requests failing with a transient error,
+    # feature_failure_rate the share of edited features rejected, max_requests_per_second throttles with 429 errors
+
+    def __init__(self, latency=0, failure_rate=0, feature_failure_rate=0, max_requests_per_second=None, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.feature_failure_rate = feature_failure_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.random = random.Random(seed)
+        self.counters = collections.Counter()
+        self.request_times = collections.deque()
+        self.lock = threading.Lock()
+
+    def request(self, operation, payload=None):
+        # count the request and apply the configured latency, throttling and failures
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters[operation] += 1
+            if payload is not None:
+                self.counters['bytes_sent'] += len(json.dumps(payload, default=str))
+            now = time.monotonic()
+            throttled = False
+            if self.max_requests_per_second is not None:
+                while self.request_times and now - self.request_times[0] > 1:
+                    self.request_times.popleft()
+                throttled = len(self.request_times) >= self.max_requests_per_second
+                if not throttled:
+                    self.request_times.append(now)
+            failed = self.random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            with self.lock:
+                self.counters['throttled'] += 1
+            raise RuntimeError('Error 429 Too Many Requests')
+        if failed:
+            with self.lock:
+                self.counters['failed'] += 1
+            raise RuntimeError('Error 503 Service Unavailable')
+
+    def feature_fails(self):
+        with self.lock:
+            return self.random.random() < self.feature_failure_rate
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.request_times.clear()
+
+
+def parse_where(where):
+    # turn the where clauses built by utils into a filter on the attributes
+    # supports 1=1, field IS NULL, field = value and field IN (values)
+    where = where.strip()
+    if where in ['1=1', '']:
+        return lambda attributes: True
+    match = re.match(r'^(\w+)\s+IS\s+NULL$', where, flags=re.IGNORECASE)
+    if match is not None:
+        return lambda attributes: attributes.get(match.group(1)) is None
+    match = re.match(r'^(\w+)\s+IN\s*\((.*)\)$', where, flags=re.IGNORECASE | re.DOTALL)
+    if match is None:
+        match = re.match(r'^(\w+)\s*=\s*(.*)$', where, flags=re.DOTALL)
+    if match is None:
+        raise RuntimeError(f"Error 400 Invalid where clause: {where}")
+    field, values = match.group(1), set(parse_values(match.group(2)))
+    return lambda attributes: attributes.get(field) in values
+
+
+def parse_values(text):
+    # parse a comma separated list of quoted strings and numbers
+    values = []
+    for match in re.finditer(r"'((?:[^']|'')*)'|(-?\d+(?:\.\d+)?)", text):
+        if match.group(1) is not None:
+            values.append(match.group(1).replace("''", "'"))
+        else:
+            number = match.group(2)
+            values.append(float(number) if '.' in number else int(number))
+    return values
+
+
+class MockLayerManager:
+    def __init__(self, layer):
+        self.layer = layer
+
+    @property
+    def properties(self):
+        return self.layer.properties
+
+    def add_to_definition(self, json_dict):
+        self.layer.service.request('add_to_definition', json_dict)
+        with self.layer.lock:
+            existing = {x['name'] for x in self.layer.properties['fields']}
+            for field in json_dict.get('fields', []):
+                if field['name'] not in existing:
+                    self.layer.properties['fields'].append(PropertyMap(field))
+        return {'success': True}
+
+    def update_definition(self, json_dict):
+        self.layer.service.request('update_definition', json_dict)
+        with self.layer.lock:
+            self.layer.properties.update(json_dict)
+        return {'success': True}
+
+
+class MockFeatureLayer:
+    # feature layer holding its rows in memory keyed by object id
+
+    def __init__(self, service, rows, fields=None, object_id_field='OBJECTID', max_record_count=2000, name='layer', url=None,
+                 append_formats='csv,geojson', gis=None, transfer_limit=None):
+        # transfer_limit caps the features of a page below max_record_count, as services do for heavy queries
+        self.service = service
+        self.transfer_limit = transfer_limit
+        self.gis = gis
+        self.lock = threading.Lock()
+        self.rows = collections.OrderedDict()
+        self.geometries = {}
+        for oid, row in enumerate(rows, start=1):
+            attributes = dict(row)
+            geometry = attributes.pop('geometry', None)
+            attributes.setdefault(object_id_field, oid)
+            self.rows[attributes[object_id_field]] = attributes
+            if geometry is not None:
+                self.geometries[attributes[object_id_field]] = geometry
+        if fields is None:
+            names = list(dict.fromkeys(name for row in self.rows.values() for name in row))
+            fields = [{'name': x, 'type': 'esriFieldTypeOID' if x == object_id_field else 'esriFieldTypeString'} for x in names]
+        self.properties = PropertyMap({'name': name,
+                                       'objectIdField': object_id_field,
+                                       'maxRecordCount': max_record_count,
+                                       'supportsAppend': bool(append_formats),
+                                       'supportedAppendFormats': append_formats,
+                                       'fields': [PropertyMap(x) for x in fields]})
+        self.url = url or f"https://mock/{name}/FeatureServer/0"
+        self.manager = MockLayerManager(self)
+
+    def make_view(self, name):
+        # layer sharing the rows of this layer with its own properties, like a hosted view
+        view = copy.copy(self)
+        view.properties = PropertyMap(self.properties, name=name, fields=list(self.properties['fields']))
+        view.url = f"https://mock/{name}/FeatureServer/0"
+        view.manager = MockLayerManager(view)
+        return view
+
+    def query(self, where='1=1', out_fields='*', return_geometry=True, order_by_fields=None, result_offset=None,
+              result_record_count=None, return_all_records=True, out_sr=None, return_count_only=False, **kwargs):
+        self.service.request('query', {'where': where})
+        condition = parse_where(where)
+        with self.lock:
+            matching = [oid for oid, attributes in self.rows.items() if condition(attributes)]
+            if return_count_only:
+                return len(matching)
+            exceeded = False
+            if not return_all_records:
+                offset = result_offset or 0
+                count = min(result_record_count or self.properties['maxRecordCount'], self.properties['maxRecordCount'],
+                            self.transfer_limit or self.properties['maxRecordCount'])
+                exceeded = offset + count < len(matching)
+                matching = matching[offset:offset + count]
+            fields = None if out_fields in ['*', None] else [x.strip() for x in out_fields.split(',')]
+            features = []
+            for oid in matching:
+                attributes = self.rows[oid]
+                attributes = dict(attributes) if fields is None else {x: attributes.get(x) for x in fields}
+                geometry = self.geometries.get(oid) if return_geometry else None
+                features.append(MockFeature(attributes, geometry))
+        return MockFeatureSet(features, exceeded)
+
+    def edit_features(self, adds=None, updates=None, deletes=None, rollback_on_failure=True, **kwargs):
+        updates = [x if isinstance(x, dict) else {'attributes': x.attributes, 'geometry': x.geometry} for x in (updates or [])]
+        adds = [x if isinstance(x, dict) else {'attributes': x.attributes, 'geometry': x.geometry} for x in (adds or [])]
+        self.service.request('edit_features', updates + adds)
+        oid_field = self.properties['objectIdField']
+        results, add_results = [], []
+        with self.lock:
+            for add in adds:
+                if self.service.feature_fails():
+                    add_results.append({'objectId': None, 'success': False, 'error': {'code': 1000, 'description': 'Mock feature failure.'}})
+                    continue
+                oid = self.add_row(add['attributes'], add.get('geometry'))
+                add_results.append({'objectId': oid, 'success': True})
+            for update in updates:
+                oid = update['attributes'].get(oid_field)
+                if oid not in self.rows:
+                    results.append({'objectId': oid, 'success': False, 'error': {'code': 1019, 'description': 'Object is missing.'}})
+                    continue
+                if self.service.feature_fails():
+                    results.append({'objectId': oid, 'success': False, 'error': {'code': 1000, 'description': 'Mock feature failure.'}})
+                    continue
+                results.append({'objectId': oid, 'success': True})
+            if rollback_on_failure and not all(x['success'] for x in results):
+                results = [dict(x, success=False) for x in results]
+            else:
+                for update, result in zip(updates, results):
+                    if result['success']:
+                        self.rows[result['objectId']].update(update['attributes'])
+                        if update.get('geometry') is not None:
+                            self.geometries[result['objectId']] = update['geometry']
+        return {'addResults': add_results, 'updateResults': results, 'deleteResults': []}
+
+    def add_row(self, attributes, geometry=None):
+        # store a new row under the next object id, the caller holds the lock
+        oid_field = self.properties['objectIdField']
+        oid = max(self.rows, default=0) + 1
+        self.rows[oid] = dict(attributes, **{oid_field: oid})
+        if geometry is not None:
+            self.geometries[oid] = geometry
+        return oid
+
+    def append(self, item_id=None, upload_format='featureCollection', source_info=None, upsert=False,
+               upsert_matching_field=None, update_geometry=True, append_fields=None, rollback=False, **kwargs):
+        # upsert the rows of an uploaded csv or geojson item, matched on upsert_matching_field
+        self.service.request('append')
+        formats = [x.strip() for x in str(self.properties['supportedAppendFormats'] or '').split(',')]
+        if not self.properties['supportsAppend'] or upload_format not in formats:
+            raise RuntimeError(f"Error 400 Append of {upload_format} is not supported")
+        item = self.gis.content.items[item_id]
+        if upload_format == 'csv':
+            import pandas as pd
+            records = [(row, None) for row in pd.read_csv(item.path, dtype=object).to_dict('records')]
+        else:
+            with open(item.path) as geojson_file:
+                records = [(x['properties'], x['geometry']) for x in json.load(geojson_file)['features']]
+        with self.lock:
+            by_key = {attributes.get(upsert_matching_field): oid for oid, attributes in self.rows.items()} if upsert else {}
+            for attributes, geometry in records:
+                if append_fields is not None:
+                    attributes = {k: v for k, v in attributes.items() if k in append_fields}
+                if geometry is not None:
+                    geometry = {'rings': geometry['coordinates']} if geometry['type'] == 'Polygon' else geometry
+                oid = by_key.get(attributes.get(upsert_matching_field))
+                if oid is None:
+                    self.add_row(attributes, geometry)
+                    continue
+                self.rows[oid].update(attributes)
+                if update_geometry and geometry is not None:
+                    self.geometries[oid] = geometry
+        return True
+
+
+class MockCollectionManager:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def create_view(self, name, capabilities=None, **kwargs):
+        # create a view item sharing the rows of the layers
+        gis = self.collection.gis
+        gis.service.request('create_view')
+        view = MockFeatureLayerCollection(gis, [x.make_view(name) for x in self.collection.layers])
+        return gis.content.register(MockItem(gis, title=name, item_type='Feature Service', collection=view))
+
+
+class MockFeatureLayerCollection:
+    def __init__(self, gis, layers):
+        self.gis = gis
+        self.layers = layers
+        self.manager = MockCollectionManager(self)
+
+
+class MockItem:
+    def __init__(self, gis, title, item_type='Feature Service', data=None, collection=None, item_id=None, path=None):
+        self.gis = gis
+        self.path = path
+        self.id = item_id or uuid.uuid4().hex
+        self.title = title
+        self.type = item_type
+        self.data = data
+        self.collection = collection
+
+    @property
+    def url(self):
+        if self.collection is None:
+            return None
+        return self.collection.layers[0].url.rsplit('/', 1)[0]
+
+    @property
+    def layers(self):
+        if self.collection is None:
+            return []
+        return self.collection.layers
+
+    def get_data(self):
+        self.gis.service.request('get_data')
+        return copy.deepcopy(self.data)
+
+    def delete(self):
+        self.gis.service.request('item.delete')
+        with self.gis.content.lock:
+            self.gis.content.items.pop(self.id, None)
+        return True
+
+    def update(self, item_properties=None, data=None, **kwargs):
+        self.gis.service.request('item.update', item_properties)
+        item_properties = item_properties or {}
+        if 'text' in item_properties:
+            self.data = json.loads(item_properties['text'])
+        for key in ['title', 'snippet', 'tags']:
+            if key in item_properties:
+                setattr(self, key, item_properties[key])
+        return True
+
+
+class MockContentManager:
+    def __init__(self, gis):
+        self.gis = gis
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, item):
+        with self.lock:
+            self.items[item.id] = item
+        return item
+
+    def get(self, item_id):
+        self.gis.service.request('content.get')
+        return self.items.get(item_id)
+
+    def search(self, query, item_type=None, max_items=10, **kwargs):
+        self.gis.service.request('content.search')
+        ids = re.findall(r'id:(\w+)', query)
+        title = re.match(r'^title:"?([^"]*)"?$', query)
+        query = title.group(1) if title else query
+        with self.lock:
+            if ids:
+                return [self.items[x] for x in ids if x in self.items][:max_items]
+            found = [x for x in self.items.values()
+                     if query.lower() in x.title.lower() and (item_type is None or item_type.lower() in x.type.lower() or
+                                                              (item_type == 'Feature Layer Collection' and x.type == 'Feature Service'))]
+        return found[:max_items]
+
+    def add(self, item_properties, data=None, text=None, **kwargs):
+        self.gis.service.request('content.add', item_properties)
+        if isinstance(data, str) and os.path.isfile(data):
+            with self.gis.service.lock:
+                self.gis.service.counters['bytes_sent'] += os.path.getsize(data)
+        item_data = json.loads(item_properties['text']) if 'text' in item_properties else text
+        return self.register(MockItem(self.gis, title=item_properties.get('title', 'title'),
+                                      item_type=item_properties.get('type', 'Shapefile'), data=item_data, path=data))
+
+    def analyze(self, item=None, file_type=None, location_type=None, **kwargs):
+        self.gis.service.request('content.analyze')
+        return {'publishParameters': {'type': file_type, 'locationType': location_type}}
+
+
+class MockGIS:
+    def __init__(self, service=None):
+        self.service = service or MockService()
+        self.content = MockContentManager(self)
+
+    def add_layer_item(self, title, rows, **layer_kwargs):
+        # publish a feature service item with one layer holding the rows
+        layer = MockFeatureLayer(self.service, rows, name=title, gis=self, **layer_kwargs)
+        collection = MockFeatureLayerCollection(self, [layer])
+        return self.content.register(MockItem(self, title=title, item_type='Feature Service', collection=collection))
+
+
+class MockSession(utils.Session):
+    # session over a MockGIS, resolving layer collections without the arcgis package
+
+    def __init__(self, gis=None, **kwargs):
+        super().__init__(gis=gis or MockGIS(), **kwargs)
+
+    def layer_collection(self, item):
+        if isinstance(item, str):
+            item = self.get_item(item)
+        return item.collection
@@ -0,0 +1,158 @@
+import datetime
+import math
+import re
+
+import numpy as np
+
+
+# where clauses with escaped values, batched IN lookups and paged queries
+# the service calls go through the call argument, call(func, **kwargs), so the caller decides on retries and budgets
+
+# longest where clause sent in one query, queries are posted so this stays well under the request size limits
+MAX_WHERE_LENGTH = 30000
+# most values in one IN list, some databases behind hosted layers refuse more than 1000
+MAX_IN_VALUES = 1000
+
+FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_.]*$')
+STRING_TYPES = ['esriFieldTypeString', 'esriFieldTypeGUID', 'esriFieldTypeGlobalID']
+NUMBER_TYPES = ['esriFieldTypeOID', 'esriFieldTypeSmallInteger', 'esriFieldTypeInteger', 'esriFieldTypeBigInteger',
+                'esriFieldTypeSingle', 'esriFieldTypeDouble']
+
+
+def direct_call(func, **kwargs):
+    return func(**kwargs)
+
+
+def quote_field(field):
+    # field names cannot be escaped, only checked
+    if not FIELD_NAME.match(str(field)):
+        raise ValueError(f"{field!r} is not a valid field name")
+    return field
+
+
+def quote_value(value, field_type=None):
+    # sql literal of the value, strings get their quotes doubled, a string field quotes numbers too
+    # and a number field takes ids read as text as numbers, raising ValueError for text which is not a number
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NULL'
+    if isinstance(value, np.generic):
+        value = value.item()
+    if field_type in STRING_TYPES:
+        value = str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+    elif field_type in NUMBER_TYPES and isinstance(value, str):
+        value = float(value) if re.search(r'[.eE]', value) else int(value)
+        if not math.isfinite(value):
+            raise ValueError(f"{value!r} is not a number")
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return f"timestamp '{value.strftime('%Y-%m-%d %H:%M:%S')}'"
+    if isinstance(value, datetime.date):
+        return f"date '{value.strftime('%Y-%m-%d')}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def equals(field, value, field_type=None):
+    # condition matching one value
+    literal = quote_value(value, field_type)
+    if literal == 'NULL':
+        return f"{quote_field(field)} IS NULL"
+    return f"{quote_field(field)} = {literal}"
+
+
+def in_clauses(field, values, field_type=None, max_length=MAX_WHERE_LENGTH, max_values=MAX_IN_VALUES):
+    # IN conditions covering the distinct values, each within max_length characters and max_values values
+    # values the field cannot hold, like text in a number field, cannot match and are left out
+    field = quote_field(field)
+    literals = []
+    for value in values:
+        try:
+            literals.append(quote_value(value, field_type))
+        except ValueError:
+            continue
+    literals = list(dict.fromkeys(literals))
+    clauses = []
+    if 'NULL' in literals:
+        literals.remove('NULL')
+        clauses.append(f"{field} IS NULL")
+    prefix_length = len(field) + len(" IN ()")
+    batch, batch_length = [], prefix_length
+    for literal in literals:
+        if batch and (len(batch) >= max_values or batch_length + len(literal) + 1 > max_length):
+            clauses.append(f"{field} IN ({','.join(batch)})")
+            batch, batch_length = [], prefix_length
+        batch.append(literal)
+        batch_length += len(literal) + 1
+    if batch:
+        clauses.append(f"{field} IN ({','.join(batch)})")
+    return clauses
+
+
+def field_type(layer, field):
+    # esri type of the field from the layer properties already loaded, None if not listed
+    for layer_field in layer.properties.get('fields') or []:
+        if layer_field['name'].lower() == str(field).lower():
+            return layer_field['type']
+    return None
+
+
+def page_count(layer, feature_count, page_size=None):
+    # number of queries paging through feature_count features takes
+    page_size = page_size or layer.properties.get('maxRecordCount') or 1000
+    return math.ceil(feature_count / page_size)
+
+
+def count(layer, where='1=1', call=direct_call):
+    # number of features matching the condition
+    return call(layer.query, where=where, return_count_only=True)
+
+
+def iter_pages(layer, where='1=1', out_fields='*', return_geometry=False, page_size=None, call=direct_call, **query_params):
+    # page through the features matching the condition in pages of the layer max record count, ordered by object id
+    # the service may send fewer features than asked for, so only a page saying it did not exceed the transfer limit
+    # is known to be the last one, otherwise the paging stops at the first empty page
+    max_record_count = layer.properties.get('maxRecordCount')
+    page_size = page_size or max_record_count or 1000
+    oid_field = layer.properties.objectIdField
+    offset = 0
+    while True:
+        feature_set = call(layer.query,
+                           where=where,
+                           out_fields=out_fields,
+                           return_geometry=return_geometry,
+                           order_by_fields=oid_field,
+                           result_offset=offset,
+                           result_record_count=page_size,
+                           return_all_records=False,
+                           **query_params)
+        if len(feature_set.features) == 0:
+            return
+        yield feature_set.features
+        offset += len(feature_set.features)
+        if exceeded_transfer_limit(feature_set) is False:
+            return
+
+
+def exceeded_transfer_limit(feature_set):
+    # the exceededTransferLimit flag of the query result, None when the result does not carry it
+    exceeded = getattr(feature_set, 'exceeded_transfer_limit', None)
+    return None if exceeded is None else bool(exceeded)
+
+
+def iter_pages_by_ids(layer, field, values, out_fields='*', return_geometry=False, page_size=None, call=direct_call,
+                      max_length=MAX_WHERE_LENGTH, max_values=MAX_IN_VALUES, **query_params):
+    # pages of the features whose field is one of the values, with as few batched IN queries as the limits allow
+    clauses = in_clauses(field, values, field_type(layer, field), max_length, max_values)
+    for where in clauses:
+        yield from iter_pages(layer, where, out_fields, return_geometry, page_size, call, **query_params)
+
+
+def fetch_by_ids(layer, field, values, out_fields='*', return_geometry=False, call=direct_call, **kwargs):
+    # features whose field is one of the values keyed by that field, a list each as ids are not always unique
+    found = {}
+    for page in iter_pages_by_ids(layer, field, values, out_fields, return_geometry, call=call, **kwargs):
+        for feature in page:
+            found.setdefault(feature.attributes[field], []).append(feature)
+    return found
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+@pytest.fixture(autouse=True)
+def offline_utils(tmp_path, monkeypatch):
+    # log to the test folder and retry without waiting against the mock service
+    utils.stop_logging()
+    utils.setup_logging(str(tmp_path / 'update_log.txt'))
+    monkeypatch.setattr(utils, 'retry_policy', utils.RetryPolicy(base_delay=0, max_delay=0))
+    yield
+    utils.stop_logging()
+    utils.metrics.reset()
@@ -0,0 +1,76 @@
+import numpy as np
+import shapely
+
+import utils
+
+
+def signed_area(ring):
+    return utils.ring_area(np.asarray(ring, dtype=float))
+
+
+def test_convert_geometries_orients_outer_rings_clockwise_and_holes_counterclockwise():
+    outer = [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]
+    hole = [(2, 2), (2, 4), (4, 4), (4, 2), (2, 2)]
+    polygon = shapely.Polygon(outer, [hole])
+    multipolygon = shapely.MultiPolygon([shapely.Polygon(outer[::-1]), shapely.Polygon([(20, 20), (21, 20), (21, 21), (20, 20)])])
+
+    converted = utils.convert_geometries([polygon, None, shapely.Polygon(), multipolygon])
+
+    assert converted[1] is None and converted[2] is None
+    outer_ring, hole_ring = converted[0]['rings']
+    assert signed_area(outer_ring) < 0 < signed_area(hole_ring)
+    assert all(signed_area(x) < 0 for x in converted[3]['rings'])
+
+
+def test_convert_geometries_matches_the_geojson_conversion():
+    polygon = shapely.Polygon([(0, 0), (0, 5), (5, 5), (5, 0), (0, 0)], [[(1, 1), (2, 1), (2, 2), (1, 2), (1, 1)]])
+
+    converted = utils.convert_geometries([polygon])[0]['rings']
+
+    assert converted == utils.esri_rings(shapely.geometry.mapping(polygon))
+
+
+def projected_frame():
+    import geopandas as gpd
+    square = shapely.Polygon([(530000, 180000), (530100, 180000), (530100, 180100), (530000, 180100)])
+    return gpd.GeoDataFrame({'Identifier': ['10000'], 'Name': ['a']}, geometry=[square], crs=27700)
+
+
+def test_geojson_upload_is_written_in_wgs84(tmp_path):
+    import json
+    file_name = utils.write_upload_file(projected_frame(), str(tmp_path), 'geojson', ['Identifier', 'Name'])
+
+    with open(file_name) as source:
+        coordinates = np.array(json.load(source)['features'][0]['geometry']['coordinates'][0])
+    assert (np.abs(coordinates[:, 0]) < 1).all() and (51 < coordinates[:, 1]).all() and (coordinates[:, 1] < 52).all()
+
+
+def test_upserted_geometries_carry_their_spatial_reference():
+    import mock_arcgis
+    gis = mock_arcgis.MockGIS(mock_arcgis.MockService(seed=0))
+    item = gis.add_layer_item('layer', [{'Identifier': '1', 'Name': 'x'}], append_formats='')
+
+    report = utils.upsert_features(item.collection, projected_frame(), list_of_update_col=['Name'])
+
+    assert report['added'] == ['10000']
+    assert list(item.collection.layers[0].geometries.values())[0]['spatialReference'] == {'wkid': 27700}
+
+
+def test_geometry_fingerprint_ignores_ring_direction_and_start_point():
+    ring = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+    hole = [[2, 2], [4, 2], [4, 4], [2, 4], [2, 2]]
+    reversed_and_rotated = [[10, 10], [0, 10], [0, 0], [10, 0], [10, 10]]
+
+    fingerprint = utils.geometry_fingerprint([ring, hole])
+
+    assert utils.geometry_fingerprint([reversed_and_rotated, hole]) == fingerprint
+    assert utils.geometry_fingerprint([hole, ring]) == fingerprint
+    assert utils.geometry_fingerprint([[[x + 1e-9, y] for x, y in ring], hole]) == fingerprint
+
+
+def test_geometry_fingerprint_detects_a_moved_vertex():
+    ring = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+    moved = [[0, 0], [0, 10], [10, 10.001], [10, 0], [0, 0]]
+
+    assert utils.geometry_fingerprint([moved]) != utils.geometry_fingerprint([ring])
+    assert utils.geometry_fingerprint([moved], precision=2) == utils.geometry_fingerprint([ring], precision=2)
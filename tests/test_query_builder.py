@@ -0,0 +1,62 @@
+import pytest
+
+import mock_arcgis
+import query_builder
+
+
+def make_layer(count, **layer_kwargs):
+    service = mock_arcgis.MockService(seed=0)
+    rows = [{'Identifier': str(10000 + i), 'Name': f'name {i}'} for i in range(count)]
+    return service, mock_arcgis.MockFeatureLayer(service, rows, **layer_kwargs)
+
+
+def test_iter_pages_follows_the_transfer_limit_past_short_pages():
+    service, layer = make_layer(25, max_record_count=10, transfer_limit=4)
+
+    pages = list(query_builder.iter_pages(layer))
+
+    assert [len(x) for x in pages] == [4, 4, 4, 4, 4, 4, 1]
+    assert service.counters['query'] == 7
+
+
+def test_iter_pages_without_the_flag_stops_at_the_empty_page():
+    service, layer = make_layer(25, max_record_count=10)
+
+    def call(func, **kwargs):
+        return mock_arcgis.MockFeatureSet(func(**kwargs).features, exceeded_transfer_limit=None)
+    pages = list(query_builder.iter_pages(layer, call=call))
+
+    assert [len(x) for x in pages] == [10, 10, 5]
+    assert service.counters['query'] == 4
+
+
+def test_quote_value_of_integral_floats_in_string_fields():
+    assert query_builder.quote_value(10000.0, 'esriFieldTypeString') == "'10000'"
+    assert query_builder.quote_value(10000.5, 'esriFieldTypeString') == "'10000.5'"
+    assert query_builder.quote_value('00123', 'esriFieldTypeInteger') == '123'
+
+
+def test_quote_value_escapes_quotes():
+    assert query_builder.quote_value("O'Brien's") == "'O''Brien''s'"
+    assert query_builder.quote_value("x' OR '1'='1") == "'x'' OR ''1''=''1'"
+    assert query_builder.quote_value(None) == 'NULL'
+    assert query_builder.quote_value(12, 'esriFieldTypeString') == "'12'"
+
+
+def test_in_clauses_batches_distinct_values_within_the_limits():
+    clauses = query_builder.in_clauses('Identifier', ["a'b", 'c', 'c', None, 'd'], 'esriFieldTypeString', max_values=2)
+
+    assert clauses == ["Identifier IS NULL", "Identifier IN ('a''b','c')", "Identifier IN ('d')"]
+    assert all(len(x) <= 40 for x in query_builder.in_clauses('Identifier', [str(i) for i in range(100)], max_length=40))
+
+
+def test_in_clauses_refuses_invalid_field_names():
+    with pytest.raises(ValueError):
+        query_builder.in_clauses('Identifier = 1 OR 1', [1])
+
+
+def test_in_clauses_leave_out_text_a_number_field_cannot_hold():
+    with pytest.raises(ValueError):
+        query_builder.quote_value('N/A', 'esriFieldTypeInteger')
+
+    assert query_builder.in_clauses('Identifier', ['12', 'N/A', 'nan', '13'], 'esriFieldTypeInteger') == ['Identifier IN (12,13)']
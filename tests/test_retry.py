@@ -0,0 +1,60 @@
+import pytest
+
+import utils
+
+
+@pytest.mark.parametrize('error', [TimeoutError('Read timed out. (read timeout=400)'),
+                                   Exception("HTTPSConnectionPool(host='services.arcgis.com', port=443): Read timed out. (read timeout=400)"),
+                                   RuntimeError('Error 429 Too Many Requests'),
+                                   RuntimeError('Error 503 Service Unavailable'),
+                                   Exception('Unable to complete operation.\n(Error Code: 504)'),
+                                   ConnectionResetError('Connection reset by peer')])
+def test_transient_errors_are_retried(error):
+    assert utils.RetryPolicy().is_retryable(error)
+
+
+@pytest.mark.parametrize('error', [RuntimeError('Error 404 not found'),
+                                   Exception('Invalid token.\n(Error Code: 498)'),
+                                   Exception('400 Client Error: Bad Request for url: https://services.arcgis.com/x/FeatureServer/0'),
+                                   RuntimeError('Cannot perform operation. Invalid operation parameters.')])
+def test_fatal_errors_are_not_retried(error):
+    assert not utils.RetryPolicy().is_retryable(error)
+
+
+def test_status_code_of_the_response_wins_over_the_message():
+    class ResponseError(Exception):
+        status_code = 403
+    assert utils.error_status_code(ResponseError('Request failed (timeout=500)')) == 403
+    assert not utils.RetryPolicy().is_retryable(ResponseError('Request failed'))
+
+
+def test_before_retry_runs_between_attempts_and_can_end_the_call():
+    policy = utils.RetryPolicy(base_delay=0, max_delay=0)
+    calls, checks = [], []
+
+    def fail():
+        calls.append(1)
+        raise TimeoutError('Read timed out.')
+
+    def check(error):
+        checks.append(error)
+        return 'applied' if len(checks) == 2 else None
+
+    assert policy.call('create', fail, before_retry=check) == 'applied'
+    assert len(calls) == 2 and len(checks) == 2
+    assert policy.summary()['create']['retries'] == 2
+
+
+def test_retry_counters_start_from_zero_for_each_run():
+    import mock_arcgis
+    import pandas as pd
+    gis = mock_arcgis.MockGIS(mock_arcgis.MockService(seed=0))
+    item = gis.add_layer_item('layer', [{'Identifier': str(i), 'Name': 'x'} for i in range(3)])
+    csv_df = pd.DataFrame({'Identifier': ['0', '1'], 'Name': ['a', 'b']})
+
+    first = utils.update_all(item.collection, csv_df, list_of_update_col=['Name'])
+    second = utils.update_all(item.collection, csv_df, list_of_update_col=['Name'])
+
+    assert first['metrics']['retries'] == second['metrics']['retries']
+    assert second['metrics']['retries']['query']['attempts'] == second['metrics']['counters']['requests'] - 1
+    assert utils.retry_policy.summary() == {}
@@ -0,0 +1,369 @@
+import numpy as np
+import pandas as pd
+
+import mock_arcgis
+import utils
+
+
+def make_layer(rows, **layer_kwargs):
+    gis = mock_arcgis.MockGIS(mock_arcgis.MockService(seed=0))
+    return gis, gis.add_layer_item('layer', rows, **layer_kwargs)
+
+
+def numeric_text_rows(count=10):
+    # hosted ids stored as text which look like numbers
+    # EditDate in epoch milliseconds like hosted date fields
+    return [{'Identifier': str(10000 + i), 'EditDate': 1500000000000, 'Name': f'name {i}', 'FASCIA': f'fascia {i}'}
+            for i in range(count)]
+
+
+def test_update_all_matches_numeric_looking_text_ids(tmp_path):
+    gis, item = make_layer(numeric_text_rows())
+    csv_file = tmp_path / 'update.csv'
+    pd.DataFrame({'Identifier': [10000 + i for i in range(10)], 'Name': [f'new {i}' for i in range(10)]}).to_csv(csv_file, index=False)
+    csv_df = pd.read_csv(csv_file)
+    assert csv_df['Identifier'].dtype.kind == 'i'
+
+    report = utils.update_all(item.collection, csv_df, list_of_update_col=['Name'])
+
+    assert report['missing'] == []
+    assert len(report['updated']) == 10
+    names = {x['Identifier']: x['Name'] for x in item.collection.layers[0].rows.values()}
+    assert names['10003'] == 'new 3'
+
+
+def test_feature_index_keys_ignore_the_id_type():
+    index = utils.FeatureIndex('Identifier', 'OBJECTID')
+    index.add({'Identifier': '10000', 'OBJECTID': 1})
+    assert index.get(10000)['OBJECTID'] == 1
+    assert index.get(10000.0)['OBJECTID'] == 1
+    assert 10000 in index
+    assert index.find_missing([10000, 10001]) == [10001]
+
+
+def test_update_new_survey_with_numeric_csv_ids():
+    gis, item = make_layer(numeric_text_rows())
+    csv_df = pd.DataFrame({'Identifier': [10000 + i for i in range(10)],
+                           'FASCIA': [f'fascia {i}' if i % 2 else f'changed {i}' for i in range(10)],
+                           'DATE_UNIX': 1600000000})
+
+    report = utils.update_new_survey(item.collection, csv_df, list_of_update_col=['FASCIA'])
+
+    assert report['plan']['counts']['missing'] == 0
+    assert sorted(report['updated']) == [10000, 10002, 10004, 10006, 10008]
+
+
+def test_changed_rows_with_numeric_csv_ids():
+    gis, item = make_layer(numeric_text_rows(4))
+    index = utils.build_feature_index(item.collection, 'Identifier', ['Name'])
+    csv_df = pd.DataFrame({'Identifier': [10000, 10001, 10002, 20000], 'Name': ['name 0', 'changed', 'name 2', 'new']})
+
+    changed = utils.changed_rows(csv_df, index, 'Identifier', ['Name'])
+
+    assert changed['Identifier'].tolist() == [10001, 20000]
+
+
+def test_upsert_resumes_from_the_checkpoint(tmp_path):
+    gis, item = make_layer(numeric_text_rows(4), append_formats='')
+    checkpoint = utils.CheckpointJournal(str(tmp_path / 'journal.sqlite'), 'upsert job')
+    checkpoint.record([10000, 20000])
+    csv_df = pd.DataFrame({'Identifier': [10000, 10001, 20000, 20001], 'Name': ['a', 'b', 'c', 'd']})
+
+    report = utils.upsert_features(item.collection, csv_df, list_of_update_col=['Name'], checkpoint=checkpoint)
+
+    assert report['method'] == 'edit_features'
+    assert report['updated'] == [10001]
+    assert report['added'] == [20001]
+    assert checkpoint.done() == set()
+    checkpoint.close()
+
+
+def test_add_timing_out_after_the_edit_is_not_sent_twice():
+    gis, item = make_layer(numeric_text_rows(2))
+    layer = item.collection.layers[0]
+    edit_features = layer.edit_features
+    calls = []
+
+    def edit_then_time_out(**kwargs):
+        calls.append(kwargs)
+        result = edit_features(**kwargs)
+        if len(calls) == 1:
+            raise TimeoutError('Read timed out.')
+        return result
+    layer.edit_features = edit_then_time_out
+    adds = [{'attributes': {'Identifier': str(20000 + i), 'Name': 'new'}} for i in range(3)]
+
+    added, failed = utils.add_features_chunked(item.collection, adds, [20000, 20001, 20002], 'Identifier')
+
+    assert sorted(added) == [20000, 20001, 20002]
+    assert failed == []
+    assert len(calls) == 1
+    identifiers = [x['Identifier'] for x in layer.rows.values()]
+    assert len(identifiers) == len(set(identifiers)) == 5
+
+
+def test_read_update_csv_keeps_leading_zeros_of_ids(tmp_path):
+    csv_file = tmp_path / 'update.csv'
+    csv_file.write_text('Identifier,Name\n00123,a\n00456,b\n')
+
+    csv_df = utils.read_update_csv(str(csv_file), 'Identifier', ['Name'], date_col=None)
+    frames = list(utils.iter_update_csv(str(csv_file), 1, 'Identifier', ['Name'], date_col=None))
+
+    assert csv_df['Identifier'].tolist() == ['00123', '00456']
+    assert [x['Identifier'].iloc[0] for x in frames] == ['00123', '00456']
+    assert utils.read_update_csv(str(csv_file), 'Identifier', ['Name'], date_col=None, dtypes={'Identifier': int})['Identifier'].tolist() == [123, 456]
+
+
+def test_update_geometry_skips_null_geometries():
+    square = {'rings': [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]}
+    gis, item = make_layer([dict(x, geometry=square) for x in numeric_text_rows(3)])
+    moved = {'type': 'Polygon', 'coordinates': [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]]}
+    features = [{'properties': {'Identifier': '10000'}, 'geometry': moved},
+                {'properties': {'Identifier': '10001'}, 'geometry': None},
+                {'properties': {'Identifier': '10002'}, 'geometry': moved}]
+
+    report = utils.update_geometry({'features': features}, item.collection, skip_unchanged=False)
+
+    assert report['empty'] == ['10001']
+    assert sorted(report['updated']) == ['10000', '10002']
+
+
+def test_checkpoint_resumes_the_same_source_only(tmp_path):
+    journal_file = str(tmp_path / 'journal.sqlite')
+    source = tmp_path / 'update.csv'
+    source.write_text('Identifier,Name\n10000,a\n10001,b\n')
+    crashed = utils.CheckpointJournal(journal_file, 'job', str(source))
+    crashed.record([10000])
+    crashed.close()
+
+    resumed = utils.CheckpointJournal(journal_file, 'job', str(source))
+    assert resumed.done() == {'10000'}
+    csv_df = utils.read_update_csv(str(source), 'Identifier', ['Name'], date_col=None)
+    assert utils.skip_checkpointed_rows(csv_df, 'Identifier', resumed)['Identifier'].tolist() == ['10001']
+    resumed.close()
+
+    source.write_text('Identifier,Name\n10000,c\n10001,d\n10002,e\n')
+    new_source = utils.CheckpointJournal(journal_file, 'job', str(source))
+    assert new_source.done() == set()
+    new_source.close()
+
+
+def test_plan_survey_updates_counts_and_changed_columns():
+    rows = [{'Identifier': str(10000 + i), 'OBJECTID': i + 1, 'EditDate': 1500000000000, 'FASCIA': f'fascia {i}', 'ACTIVITY': 'shop'}
+            for i in range(4)]
+    index = utils.FeatureIndex('Identifier', 'OBJECTID')
+    for row in rows:
+        index.add(row)
+    csv_df = pd.DataFrame({'Identifier': [10000, 10001, 10002, 10003, 20000],
+                           'DATE_UNIX': [1600000000, 1400000000, 1600000000, 1600000000, 1600000000],
+                           'FASCIA': ['changed', 'changed', 'fascia 2', 'fascia 3', 'new'],
+                           'ACTIVITY': ['shop', 'shop', 'shop', 'cafe', 'shop']})
+
+    plan = utils.plan_survey_updates(csv_df, index, 'Identifier', ['FASCIA', 'ACTIVITY'])
+
+    assert plan['counts'] == {'rows': 5, 'missing': 1, 'not_newer': 1, 'unchanged': 1, 'to_update': 2,
+                              'columns': {'FASCIA': 1, 'ACTIVITY': 1}}
+    updates, id_by_oid = utils.make_plan_payloads(plan)
+    assert updates == [{'attributes': {'OBJECTID': 1, 'FASCIA': 'changed'}}, {'attributes': {'OBJECTID': 4, 'ACTIVITY': 'cafe'}}]
+    assert id_by_oid == {1: 10000, 4: 10003}
+
+
+def test_create_view_timing_out_after_the_view_was_created_uses_that_view():
+    gis, item = make_layer(numeric_text_rows(2))
+    session = mock_arcgis.MockSession(gis)
+    manager = item.collection.manager
+    create_view = manager.create_view
+    calls = []
+
+    def create_then_time_out(**kwargs):
+        calls.append(kwargs)
+        create_view(**kwargs)
+        raise TimeoutError('Read timed out.')
+    manager.create_view = create_then_time_out
+    views_dict = {}
+
+    utils.create_view_column(session, item.collection, 'A1', 'Colour Bin Shops', views_dict)
+
+    views = [x for x in gis.content.items.values() if x.title == 'view_A1']
+    assert len(calls) == 1 and len(views) == 1
+    assert views_dict == {'A1': views[0].id}
+    assert views[0].layers[0].properties['name'] == 'Shops'
+
+
+def test_create_view_column_renames_without_looking_the_view_up():
+    gis, item = make_layer(numeric_text_rows(2))
+    session = mock_arcgis.MockSession(gis)
+    views_dict = {}
+
+    utils.create_view_column(session, item.collection, 'A1', 'Colour Bin Shops', views_dict)
+
+    assert gis.service.counters['create_view'] == 1
+    assert gis.service.counters['content.get'] == 0
+    assert session.get_item(views_dict['A1']).layers[0].properties['name'] == 'Shops'
+
+
+def test_update_all_reports_text_ids_of_a_number_field_as_missing():
+    rows = [{'Identifier': 10000 + i, 'EditDate': 1500000000000, 'Name': f'name {i}'} for i in range(3)]
+    fields = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}, {'name': 'Identifier', 'type': 'esriFieldTypeInteger'},
+              {'name': 'EditDate', 'type': 'esriFieldTypeDate'}, {'name': 'Name', 'type': 'esriFieldTypeString'}]
+    gis, item = make_layer(rows, fields=fields)
+    csv_df = pd.DataFrame({'Identifier': ['10000', 'N/A', '10002'], 'Name': ['a', 'b', 'c']})
+
+    report = utils.update_all(item.collection, csv_df, list_of_update_col=['Name'])
+    index = utils.build_feature_index(item.collection, 'Identifier', ['Name'], identifiers=csv_df['Identifier'], lookup='ids')
+
+    assert sorted(index.features) == ['10000', '10002']
+
+    assert report['missing'] == ['N/A']
+    assert sorted(report['updated']) == ['10000', '10002']
+
+
+def test_failed_job_does_not_leak_its_metrics_into_the_next_job(tmp_path):
+    import jobs
+    gis, item = make_layer(numeric_text_rows(2))
+    session = mock_arcgis.MockSession(gis)
+    job = jobs.make_jobs({'jobs': [{'item_id': item.id, 'mode': 'update_all', 'update_cols': ['Name'],
+                                    'source': str(tmp_path / 'missing.csv')}]})[0]
+
+    summary = jobs.run_job(job, 1, session)
+
+    assert summary['status'] == 'error'
+    assert utils.metrics.summary()['phases'] == {}
+    assert utils.metrics.summary()['counters'] == {}
+
+
+def test_small_integer_columns_get_a_full_integer_field():
+    assert utils.infer_field_type(np.dtype('int64'), pd.Series([1, 2, 3, 4])) == 'esriFieldTypeInteger'
+    assert utils.infer_field_type(np.dtype('int64'), pd.Series([1, 2 ** 40])) == 'esriFieldTypeDouble'
+
+
+def test_layer_schema_matches_field_names_without_case():
+    gis, item = make_layer(numeric_text_rows(2))
+    schema = utils.LayerSchema(item.collection)
+    df = pd.DataFrame({'name': ['a'], 'Rating': [3], 'RATING': [4]})
+
+    assert schema.new_columns(df) == ['Rating']
+    assert schema.add(utils.infer_fields(df, ['name', 'Rating', 'RATING'])) == ['Rating']
+    assert schema.field_type('rating') == 'esriFieldTypeInteger'
+
+
+def test_single_write_map_json_creates_the_map_layer_dict():
+    gis = mock_arcgis.MockGIS(mock_arcgis.MockService(seed=0))
+    session = mock_arcgis.MockSession(gis)
+    rows = [{'OBJECTID': 1, 'A1': 2, 'WardCODE': 'E1'}]
+    fields = [{'name': x, 'type': 'esriFieldTypeString'} for x in ['OBJECTID', 'A1', 'WardCODE']]
+    views = {key: gis.add_layer_item('view_' + key, rows, fields=fields).id for key in ['A1', 'B2']}
+
+    web_map_item = utils.create_map_add_views(views, session=session, single_write=True)
+
+    map_json = web_map_item.get_data()
+    assert [x['visibility'] for x in map_json['operationalLayers']] == [False, False]
+    assert utils.make_map_layer_dict(map_json) == {'A1_ward': 'view_A1', 'B2_ward': 'view_B2'}
+
+
+def test_survey_dates_are_parsed_with_a_fixed_format(tmp_path):
+    csv_file = tmp_path / 'survey.csv'
+    csv_file.write_text('Identifier,FASCIA,Survey_Dat\n1,a,2020-09-13\n2,b,2020-09-13 12:00:00\n3,c,\n')
+
+    csv_df = utils.read_update_csv(str(csv_file), 'Identifier', ['FASCIA'])
+
+    assert csv_df['DATE_UNIX'].tolist()[:2] == [1599955200, 1599998400]
+    assert pd.isna(csv_df['DATE_UNIX'].iloc[2])
+
+    csv_file.write_text('Identifier,FASCIA,Survey_Dat\n1,a,01/02/2020\n')
+    assert utils.read_update_csv(str(csv_file), 'Identifier', ['FASCIA'], date_format='%d/%m/%Y')['DATE_UNIX'].tolist() == [1580515200]
+
+
+def layer_hierarchy():
+    return pd.DataFrame({'Group': ['G1', 'G1', 'G1', 'G2'],
+                         'SubGroup': ['S1', 'S1', 'S2', 'S3'],
+                         'New_Code': ['A1_ward', 'A2_ward', 'B1_ward', 'C1_ward'],
+                         'Order': [4, 3, 2, 1],
+                         'has_view': 'yes'})
+
+
+def test_layer_tree_matches_recur_dictify_and_lists_codes():
+    frame = layer_hierarchy()[['Group', 'SubGroup', 'New_Code']]
+    tree = utils.LayerTree(frame)
+
+    assert utils.recur_dictify(frame) == {'G1': {'S1': ['A1_ward', 'A2_ward'], 'S2': 'B1_ward'}, 'G2': {'S3': 'C1_ward'}}
+    assert tree.codes() == ['A1_ward', 'A2_ward', 'B1_ward', 'C1_ward']
+    assert tree.codes('G1') == ['A1_ward', 'A2_ward', 'B1_ward']
+    assert tree.keys('G1') == ['S1', 'S2']
+
+
+def test_sync_layer_groups_patches_only_the_changed_flags():
+    plan = {'G1': {'w0': {'label': 'S1', 'layers': {'view_A1'}}}}
+    widget = {'id': 'w0', 'label': 'S1', 'config': {'layerOptions': {'view_A1': {'display': True}, 'view_B1': {'display': True}}}}
+    app_json = {'widgetPool': {'groups': [{'id': 'G1', 'widgets': [widget]}]}}
+
+    changes = utils.sync_layer_groups(app_json, plan, {}, {}, {'view_A1', 'view_B1'})
+
+    assert changes == 1
+    assert app_json['widgetPool']['groups'][0]['widgets'][0] is widget
+    assert widget['config']['layerOptions'] == {'view_A1': {'display': True}, 'view_B1': {'display': False}}
+    assert utils.sync_layer_groups(app_json, plan, {}, {}, {'view_A1', 'view_B1'}) == 0
+
+
+def test_create_layer_groups_skips_the_upload_when_nothing_changed(tmp_path):
+    import json
+    gis = mock_arcgis.MockGIS(mock_arcgis.MockService(seed=0))
+    session = mock_arcgis.MockSession(gis)
+    csv_file = tmp_path / 'hierarchy.csv'
+    layer_hierarchy().to_csv(csv_file, index=False)
+    fields = [{'fieldName': x} for x in ['OBJECTID', 'Name', 'WardCODE']]
+    map_json = {'operationalLayers': [{'id': 'view_' + code, 'popupInfo': {'fieldInfos': fields},
+                                       'layerDefinition': {'drawingInfo': {'renderer': {'field': code}}}}
+                                      for code in ['A1', 'A2', 'B1', 'C1']]}
+    web_map = gis.content.add({'title': 'map', 'type': 'Web Map', 'text': json.dumps(map_json)})
+    app_json = {'widgetPool': {'groups': [{'id': 'G1', 'label': 'G1', 'widgets': [{'id': 'widgets_LayerList_Widget_G1_0', 'label': 'S1'}]}]}}
+    web_app = gis.content.add({'title': 'app', 'type': 'Web Mapping Application', 'text': json.dumps(app_json)})
+
+    utils.create_layer_groups(str(csv_file), web_map, web_app, session)
+    groups = web_app.get_data()['widgetPool']['groups']
+    utils.create_layer_groups(str(csv_file), web_map, web_app, session)
+
+    assert gis.service.counters['item.update'] == 1
+    assert [x['id'] for x in groups] == ['G1', 'G2']
+    assert [x['label'] for x in groups[0]['widgets']] == ['S1', 'S2']
+    assert groups[1]['widgets'][0]['config']['layerOptions']['view_C1'] == {'display': True}
+    assert groups[1]['widgets'][0]['config']['layerOptions']['view_A1'] == {'display': False}
+
+
+def test_adaptive_limiter_shrinks_on_throttling_and_grows_back():
+    limiter = utils.AdaptiveLimiter(8, grow_after=2)
+
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.limit == 2
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.limit == 1
+
+    for _ in range(4):
+        limiter.on_success()
+    assert limiter.limit == 3
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.limit == 8
+
+
+
+def test_edit_chunk_reports_throttling_to_the_limiter():
+    gis, item = make_layer(numeric_text_rows(2))
+    layer = item.collection.layers[0]
+    edit_features = layer.edit_features
+    calls = []
+
+    def throttle_once(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise RuntimeError('Error 429 Too Many Requests')
+        return edit_features(**kwargs)
+    layer.edit_features = throttle_once
+    limiter = utils.AdaptiveLimiter(4)
+
+    result = utils.edit_chunk_func(item.collection, [{'attributes': {'OBJECTID': 1, 'Name': 'x'}}], limiter)
+
+    assert result['updateResults'][0]['success']
+    assert limiter.limit == 2 and limiter.in_flight == 0 and limiter.success_streak == 1
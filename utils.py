@@ -1,46 +1,456 @@
+import atexit
 import collections
+import contextlib
 import copy
-import credentials as cred
-import geopandas as gpd
+import hashlib
+import itertools
 import json
 import logging
+import numpy as np
+import os
 import pandas as pd
+import queue
+import random
+import sqlite3
+import threading
 import time
 import traceback
 import re
 
-from arcgis.gis import GIS
-from arcgis.features import FeatureLayer
-from arcgis.features import FeatureLayerCollection
-from arcgis.mapping import WebMap
+import query_builder
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from copy import deepcopy
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pandas import read_csv
 from pprint import pprint
 
 
-# intiate the logger and format it 
+# the heavy GIS libraries (arcgis, geopandas, fiona) and the credentials are imported where they are used
+# so the local helpers import quickly and work offline
+
+# intiate the logger, the file handlers are added on first use and written from a background thread
+# through a queue so logging never waits on the disk
 logger = logging.getLogger("update")
 logger.setLevel(logging.DEBUG)
-handler = RotatingFileHandler("Logs/update_log.txt", maxBytes=1000000, backupCount=200)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+# structured events, one json object per line, go to their own file
+event_logger = logging.getLogger("update.events")
+LOG_FILE = "Logs/update_log.txt"
+EVENTS_FILE = "Logs/update_events.jsonl"
+# json lines file the summary of every run is appended to, None to only log it
+METRICS_FILE = None
+_log_handler = None
+_log_listener = None
+_log_pid = None
+
+
+def setup_logging(log_file=None, events_file=None, metrics_file=None):
+    # add the queue handler and start the thread writing the rotating log and events files, once, and mark the start of the log
+    global _log_handler, _log_listener, _log_pid, METRICS_FILE
+    if metrics_file is not None:
+        METRICS_FILE = metrics_file
+    if _log_handler is not None and _log_pid == os.getpid():
+        return
+    if _log_handler is not None:
+        # a forked process inherits the handler but not the thread writing its queue
+        logger.removeHandler(_log_handler)
+    log_file = log_file or LOG_FILE
+    events_file = events_file or os.path.join(os.path.dirname(log_file), os.path.basename(EVENTS_FILE))
+    for file_name in [log_file, events_file]:
+        if os.path.dirname(file_name):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+    text_handler = RotatingFileHandler(log_file, maxBytes=1000000, backupCount=200)
+    text_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    text_handler.addFilter(lambda record: record.name != event_logger.name)
+    events_handler = RotatingFileHandler(events_file, maxBytes=10000000, backupCount=20)
+    events_handler.setFormatter(logging.Formatter('%(message)s'))
+    events_handler.addFilter(logging.Filter(event_logger.name))
+
+    _log_handler = QueueHandler(queue.SimpleQueue())
+    _log_listener = QueueListener(_log_handler.queue, text_handler, events_handler, respect_handler_level=True)
+    _log_listener.start()
+    _log_pid = os.getpid()
+    logger.addHandler(_log_handler)
+    atexit.register(stop_logging)
+    # mark the start of the log
+    logger.debug('- - - - - - NEW LOG STARTS HERE - - - - - -')
+
+
+def stop_logging():
+    # write the queued records and close the files, setup_logging starts again on the next use
+    global _log_handler, _log_listener
+    if _log_handler is None or _log_pid != os.getpid():
+        return
+    logger.removeHandler(_log_handler)
+    _log_listener.stop()
+    for handler in _log_listener.handlers:
+        handler.close()
+    _log_handler, _log_listener = None, None
 
 
 def print_text_log(text_body):
     # print and logging function 
+    setup_logging()
     print(text_body)
     logger.debug(str(text_body))
 
-# mark the start of the log
-logger.debug('- - - - - - NEW LOG STARTS HERE - - - - - -')
-
-gis = GIS("https://www.arcgis.com", cred.user, cred.password)
-print_text_log("Loggin in complete!")
 
-
-def upload_publish(item_file_location, title='title', tags='tags'):
+def log_event(event, **fields):
+    # log a structured event as one json line of the events file
+    setup_logging()
+    if event_logger.isEnabledFor(logging.DEBUG):
+        event_logger.debug(json.dumps(dict({'time': round(time.time(), 3), 'event': event}, **fields), default=str))
+
+
+class RunMetrics:
+    # per phase timers and counters (rows, requests, bytes, retries) of a run, shared by the functions it calls
+    # the top level functions log the summary at their end and start the next run from zero, the counters of the
+    # retry policy included
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases = collections.Counter()
+            self.counters = collections.Counter()
+            self.started = None
+
+    def count(self, counter, value=1):
+        with self.lock:
+            if self.started is None:
+                self.started = time.perf_counter()
+            self.counters[counter] += value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # time the block, the seconds are added to the phase and set on the yielded dict
+        timer = {}
+        start = time.perf_counter()
+        with self.lock:
+            if self.started is None:
+                self.started = start
+        try:
+            yield timer
+        finally:
+            timer['seconds'] = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] += timer['seconds']
+
+    def summary(self, run=None):
+        with self.lock:
+            return {'run': run,
+                    'seconds': round(time.perf_counter() - self.started, 3) if self.started is not None else 0,
+                    'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                    'counters': dict(self.counters)}
+
+    def finish(self, run):
+        # log the summary of the run, append it to the metrics file if set, and start the next run
+        summary = self.summary(run)
+        summary['retries'] = retry_policy.summary()
+        phases = ', '.join(f"{name} {seconds:.2f}" for name, seconds in summary['phases'].items())
+        counters = ', '.join(f"{counter} {value}" for counter, value in summary['counters'].items())
+        print_text_log(f"{run} took {summary['seconds']:.2f} seconds ({phases}), {counters}")
+        log_event('run_summary', **summary)
+        if METRICS_FILE is not None:
+            if os.path.dirname(METRICS_FILE):
+                os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
+            with open(METRICS_FILE, 'a') as metrics_object:
+                metrics_object.write(json.dumps(dict(summary, time=time.time()), default=str) + '\n')
+        self.reset()
+        retry_policy.reset()
+        return summary
+
+
+# metrics shared by all functions, like the retry policy
+metrics = RunMetrics()
+
+
+class Session:
+    # connection to ArcGIS online which logs in on first use and caches the item and layer handles it resolves
+    # pass gis to reuse an existing connection, or username and password instead of the credentials module
+    # cached handles expire after cache_ttl seconds, or earlier through invalidate
+
+    def __init__(self, url="https://www.arcgis.com", username=None, password=None, gis=None, cache_ttl=600, pool_maxsize=20):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.cache_ttl = cache_ttl
+        self.pool_maxsize = pool_maxsize
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self._gis = gis
+        self.lock = threading.Lock()
+        if gis is not None:
+            self.configure_pool(gis)
+
+    def connect(self):
+        from arcgis.gis import GIS
+        username, password = self.username, self.password
+        if username is None:
+            import credentials as cred
+            username, password = cred.user, cred.password
+        gis = GIS(self.url, username, password)
+        self.configure_pool(gis)
+        print_text_log("Loggin in complete!")
+        return gis
+
+    def configure_pool(self, gis):
+        # let the keep-alive connection pool of the GIS hold enough connections for the worker threads
+        http_session = getattr(getattr(gis, '_con', None), '_session', None)
+        if http_session is None or not hasattr(http_session, 'mount'):
+            return
+        from requests.adapters import HTTPAdapter
+        # only plain adapters are resized, keeping their retries; the subclasses the GIS mounts for its own
+        # authentication or certificates are left alone
+        for prefix, adapter in list(getattr(http_session, 'adapters', {}).items()):
+            if type(adapter) is not HTTPAdapter:
+                logger.debug(f"Connection pool of {prefix} left as is, its adapter is a {type(adapter).__name__}")
+                continue
+            if getattr(adapter, '_pool_maxsize', 0) >= self.pool_maxsize:
+                continue
+            http_session.mount(prefix, HTTPAdapter(pool_connections=self.pool_maxsize, pool_maxsize=self.pool_maxsize,
+                                                   max_retries=adapter.max_retries, pool_block=getattr(adapter, '_pool_block', False)))
+
+    @property
+    def gis(self):
+        with self.lock:
+            if self._gis is None:
+                self._gis = self.connect()
+        return self._gis
+
+    @property
+    def connected(self):
+        return self._gis is not None
+
+    def cached(self, key, loader):
+        # return the cached value of the key if still fresh, otherwise load and cache it
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.cache_ttl:
+                return entry[1]
+        value = loader()
+        with self.cache_lock:
+            self.cache[key] = (time.monotonic(), value)
+        return value
+
+    def get_item(self, item_id):
+        return self.cached(('item', item_id), lambda: self.gis.content.get(item_id))
+
+    def search_items(self, query, item_type=None):
+        return self.cached(('search', query, item_type), lambda: self.gis.content.search(query, item_type=item_type))
+
+    def get_items(self, item_ids, batch_size=50):
+        # resolve many items with a few searches by id instead of one request per item
+        items = {}
+        pending = [x for x in dict.fromkeys(item_ids) if self.cached_item(x) is None]
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            query = ' OR '.join(f'id:{x}' for x in batch)
+            for item in self.gis.content.search(query, max_items=len(batch)):
+                self.remember_item(item)
+        for item_id in dict.fromkeys(item_ids):
+            items[item_id] = self.cached_item(item_id) or self.get_item(item_id)
+        return items
+
+    def cached_item(self, item_id):
+        with self.cache_lock:
+            entry = self.cache.get(('item', item_id))
+        if entry is not None and time.monotonic() - entry[0] < self.cache_ttl:
+            return entry[1]
+        return None
+
+    def layer_collection(self, item):
+        # FeatureLayerCollection of the item, or of the item id
+        from arcgis.features import FeatureLayerCollection
+        if isinstance(item, str):
+            item = self.get_item(item)
+        return self.cached(('layers', item.id), lambda: FeatureLayerCollection.fromitem(item))
+
+    def remember_item(self, item):
+        # cache an item handle returned by a create or save call
+        with self.cache_lock:
+            self.cache[('item', item.id)] = (time.monotonic(), item)
+        return item
+
+    def invalidate(self, item_id=None):
+        # drop the cached handles of the item and every cached search, or everything without an item id
+        with self.cache_lock:
+            if item_id is None:
+                self.cache.clear()
+                return
+            for key in list(self.cache.keys()):
+                if key[0] == 'search' or key[1] == item_id:
+                    del self.cache[key]
+
+    def invalidate_searches(self):
+        # drop the cached searches, called after content is created so new items can be found
+        with self.cache_lock:
+            for key in [x for x in self.cache.keys() if x[0] == 'search']:
+                del self.cache[key]
+
+
+_session = None
+
+
+def get_session():
+    # return the default session, created on first use
+    global _session
+    if _session is None:
+        _session = Session()
+    return _session
+
+
+def set_session(session):
+    # replace the default session, for example with one using another account or an existing GIS
+    global _session
+    _session = session
+    return session
+
+
+def __getattr__(name):
+    # keep utils.gis working for scripts written before the lazy session
+    if name == 'gis':
+        return get_session().gis
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def backoff_delay(attempt, base=1, cap=60):
+    # exponential backoff bounded by the cap with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# an http status code standing on its own in an error message, not part of a number, a url, a port or a setting
+# like host:443 or (read timeout=400)
+STATUS_CODE = re.compile(r'(?<![\w.:=/-])([1-5]\d\d)(?![\w.:=/-])')
+# status codes worth trying again, the server errors and the timeouts and throttling among the client errors
+RETRYABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+# error types which always mean the request did not get through or its answer did not come back
+NETWORK_ERRORS = (ConnectionError, TimeoutError)
+
+RETRYABLE_ERROR_TEXT = ['timed out', 'timeout', 'connection', 'temporarily', 'unavailable',
+                        'too many requests', 'throttl', 'rate limit']
+FATAL_ERROR_TEXT = ['invalid', 'not found', 'does not exist', 'permission', 'token required']
+
+
+def error_status_code(error):
+    # http status code of the error, from its response when it has one or else from its message, None if neither tells
+    response = getattr(error, 'response', None)
+    code = getattr(error, 'status_code', None) or getattr(response, 'status_code', None)
+    if code is not None:
+        return int(code)
+    match = STATUS_CODE.search(str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_throttle_error(error):
+    # check if the service refused the request because of too many requests
+    text = str(error).lower()
+    return error_status_code(error) == 429 or any(x in text for x in ['too many requests', 'throttl', 'rate limit'])
+
+
+class RetryPolicy:
+    # retry service calls with bounded exponential backoff and count where the time goes
+
+    def __init__(self, max_attempts=8, deadline=None, base_delay=1, max_delay=60,
+                 retryable_errors=(RuntimeError, ConnectionError, TimeoutError)):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable_errors = retryable_errors
+        self.counters = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+
+    def is_retryable(self, error):
+        # classify the error as transient or fatal, throttling and network errors first, then the status code
+        # and only then the words of the message
+        if is_throttle_error(error) or isinstance(error, NETWORK_ERRORS):
+            return True
+        code = error_status_code(error)
+        if code is not None and code >= 400:
+            return code in RETRYABLE_STATUS_CODES
+        text = str(error).lower()
+        if any(x in text for x in FATAL_ERROR_TEXT):
+            return False
+        if isinstance(error, self.retryable_errors):
+            return True
+        return any(x in text for x in RETRYABLE_ERROR_TEXT)
+
+    def count(self, operation, counter, value=1):
+        with self.lock:
+            self.counters[operation][counter] += value
+
+    def call(self, operation, func, *args, before_retry=None, **kwargs):
+        # call the function and try again on transient errors until the attempts or the deadline run out
+        # before_retry(error) runs after the wait before each new attempt, for calls which are not idempotent
+        # to check what the failed attempt did; a value other than None is returned instead of trying again
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.count(operation, 'attempts')
+            metrics.count('requests')
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                if not self.is_retryable(error):
+                    self.count(operation, 'fatal')
+                    print_text_log(f"{operation} failed with a fatal error: {error}")
+                    raise
+                delay = backoff_delay(attempt - 1, self.base_delay, self.max_delay)
+                out_of_time = self.deadline is not None and time.monotonic() - start + delay > self.deadline
+                if attempt >= self.max_attempts or out_of_time:
+                    self.count(operation, 'exhausted')
+                    print_text_log(f"{operation} failed after {attempt} attempts: {error}")
+                    raise
+                self.count(operation, 'retries')
+                metrics.count('retries')
+                self.count(operation, 'wait_time', delay)
+                print_text_log(f"{operation} failed with {error}, attempt {attempt} of {self.max_attempts}, trying again in {delay:.1f} seconds")
+                time.sleep(delay)
+                if before_retry is not None:
+                    value = before_retry(error)
+                    if value is not None:
+                        return value
+
+    def summary(self):
+        with self.lock:
+            return {operation: dict(counter) for operation, counter in self.counters.items()}
+
+    def log_summary(self):
+        for operation, counter in self.summary().items():
+            print_text_log(f"{operation}: {counter.get('attempts', 0)} attempts, {counter.get('retries', 0)} retries, "
+                           f"{counter.get('wait_time', 0):.1f} seconds waiting, {counter.get('fatal', 0) + counter.get('exhausted', 0)} failures")
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+
+
+# retry policy shared by all service calls, replace or adjust it to change the behaviour
+retry_policy = RetryPolicy()
+
+# semaphore shared by the processes of a job run to cap their queries and edits in flight, see jobs.py
+request_budget = None
+
+
+def set_request_budget(semaphore):
+    global request_budget
+    request_budget = semaphore
+
+
+def call_with_budget(func, *args, **kwargs):
+    # call the service holding a slot of the shared request budget if there is one
+    if request_budget is None:
+        return func(*args, **kwargs)
+    with request_budget:
+        return func(*args, **kwargs)
+
+
+def upload_publish(item_file_location, title='title', tags='tags', session=None):
     # log in and upload a shapfile and then publish it as a serivce
     
     item_properties = {
@@ -49,19 +459,62 @@ def upload_publish(item_file_location, title='title', tags='tags'):
     'type': 'Shapefile'
     }
 
-    item_shp = gis.content.add(item_properties, data=item_file_location)
-    published_layer_item = item_shp.publish()
+    session = session or get_session()
+    item_shp = session.gis.content.add(item_properties, data=item_file_location)
+    published_layer_item = session.remember_item(item_shp.publish())
+    session.invalidate_searches()
 
     return published_layer_item
 
-def create_views_columns(item_file_location, csv_file_location, feature_layer_item, col_filter=None):
+def find_view_item(session, view_name):
+    # the view item of the name if it was created already, None otherwise
+    for item in session.gis.content.search(f'title:"{view_name}"', item_type='Feature Service'):
+        if item.title == view_name:
+            return item
+    return None
+
+
+def create_view_column(session, flc, key, col_name, views_dict, find_existing=False):
+    # create the view of a col unless it already exists and rename it to the col name, the created item is cached
+    # in the session so the rename does not look it up again
+    # create_view is not idempotent, a call which timed out may have created the view, so before sending it again,
+    # or with find_existing before the first call, a view of the same name is looked up and used instead
+    timing = {}
+    view_name = 'view_' + key
+
+    def use_created_view(error):
+        item = find_view_item(session, view_name)
+        if item is not None:
+            print_text_log(f"view {view_name} already exists, using it")
+        return item
+
+    if key not in views_dict:
+        with metrics.phase('create_view') as timer:
+            view = use_created_view(None) if find_existing else None
+            if view is None:
+                view = retry_policy.call('create_view', flc.manager.create_view, name=view_name, capabilities='Query, Update, Delete',
+                                         before_retry=use_created_view)
+            views_dict[key] = session.remember_item(view).id
+        timing['create'] = timer['seconds']
+
+    with metrics.phase('rename_view') as timer:
+        view_manager = session.get_item(views_dict[key]).layers[0].manager
+        retry_policy.call('update_definition', view_manager.update_definition, {'name':col_name.split('Colour Bin ')[1].strip()})
+    timing['rename'] = timer['seconds']
+    return timing
+
+
+def create_views_columns(item_file_location, csv_file_location, feature_layer_item, col_filter=None, max_workers=8, view_retries=2, session=None):
     # create views and return dict of the view codes and ids
+    import geopandas as gpd
+    session = session or get_session()
 
     # read geodataframe from zip file 
-    gdf = gpd.read_file(r'/vsizip/'+item_file_location)
+    with metrics.phase('read_file'):
+        gdf = gpd.read_file(r'/vsizip/'+item_file_location)
     
     # apply filter or jsut remove geometry from geodataframe col list if no filter provided 
-    if filter: 
+    if col_filter: 
         col_list = [x for x in list(gdf.keys()) if col_filter in x]
     else: 
         col_list = [x for x in list(gdf.keys()) if not x == 'geometry']
@@ -83,188 +536,196 @@ def create_views_columns(item_file_location, csv_file_location, feature_layer_it
     if not len(set(df['New_Code']) - set(col_list)) == 0 or not len(set(col_list) - set(df['New_Code'])) == 0: 
         return ("ERROR, Please check the consistancy of the columns in the shapfile and the csv!")
 
-    flc = FeatureLayerCollection.fromitem(feature_layer_item)
+    flc = session.layer_collection(feature_layer_item)
 
-    # create new view for each col and fill the views dict
+    # create and rename the views in parallel, then retry the failed ones one by one
     views_dict = {}
-    base_time = time.time()
-
-    for key, value in df_dict.items():
-        loop_time = time.time()
-        views_dict[key] = (flc.manager.create_view(name='view_'+key, capabilities='Query, Update, Delete')).id
-        print_text_log (f"time to create {str(key)} is {str(time.time() - loop_time)}")
+    failed_views = {}
+    pending = list(df_dict.keys())
+
+    for attempt in range(view_retries + 1):
+        failed_views = {}
+        with ThreadPoolExecutor(max_workers=max_workers if attempt == 0 else 1) as executor:
+            futures = {executor.submit(create_view_column, session, flc, key, df_dict[key], views_dict, attempt > 0): key for key in pending}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    timing = future.result()
+                    metrics.count('views')
+                    log_event('view', code=key, attempt=attempt + 1, create_seconds=timing.get('create', 0), rename_seconds=timing['rename'])
+                except Exception as error:
+                    failed_views[key] = error
+                    print_text_log(f"view {key} failed: {error}")
+
+        pending = list(failed_views.keys())
+        if len(pending) == 0:
+            break
+        if attempt < view_retries:
+            print_text_log(f"{len(pending)} views failed, retrying them one by one")
+
+    retry_policy.log_summary()
+    metrics.finish('create_views_columns')
 
-    print_text_log (f'full time = {str(time.time() - base_time)}')
-
-    # change the name of each view to the name of the col instead of the code
-    failed_views = []
-    for key, value in views_dict.items():
-        try :
-            gis.content.get(views_dict[key]).layers[0].manager.update_definition({'name':df_dict[key].split('Colour Bin ')[1].strip()})
-        except: 
-            failed_views.append(key)
-    
     if not len(failed_views) == 0:
-        return("ERROR, please check the layer service")
+        logger.debug(str(failed_views))
+        return(f"ERROR, please check the layer service, views failed for {str(list(failed_views.keys()))}")
+
+    # keep the order of the cols as it is the order of the layers in the map
+    return {key: views_dict[key] for key in df_dict.keys()}
+
+
+# style of the class breaks renderer used for the views, a json file with the same keys can replace it
+DEFAULT_RENDERER_STYLE = {
+    "min_value": 1,
+    "breaks": [1, 2, 3, 4],
+    "colors": [[90, 106, 56, 255], [117, 144, 67, 255], [143, 178, 77, 255], [200, 223, 158, 255]],
+    "outline": {"color": [194, 194, 194, 64], "width": 0.75},
+    "size_stops": [{"size": 1.5, "value": 50921},
+                   {"size": 0.75, "value": 159129},
+                   {"size": 0.375, "value": 636517},
+                   {"size": 0, "value": 1273034}]
+}
+
+
+def interpolate_colors(start_color, end_color, count):
+    # linear color ramp of count colors between two colors
+    if count == 1:
+        return [list(start_color)]
+    return [[round(a + (b - a) * i / (count - 1)) for a, b in zip(start_color, end_color)] for i in range(count)]
+
+
+class RendererFactory:
+    # build the shared parts of the class breaks renderer once and stamp out a renderer per field
+    # style keys: min_value, breaks, labels (optional), colors (one per break, or two ends of a ramp), outline, size_stops
+
+    def __init__(self, style=None):
+        if isinstance(style, str):
+            style = self.load_style(style)
+        style = dict(DEFAULT_RENDERER_STYLE, **(style or {}))
+        breaks = style['breaks']
+        colors = style['colors']
+        if len(colors) != len(breaks):
+            if len(colors) != 2:
+                raise ValueError(f"Style needs one color per break or the two ends of a ramp, got {len(colors)} colors for {len(breaks)} breaks")
+            colors = interpolate_colors(colors[0], colors[1], len(breaks))
+        labels = style.get('labels') or [str(x) for x in breaks]
+
+        outline = {"color": style['outline']['color'],
+                   "width": style['outline']['width'],
+                   "type": "esriSLS",
+                   "style": "esriSLSSolid"}
+        self.min_value = style['min_value']
+        self.size_stops = [dict(x) for x in style['size_stops']]
+        self.class_break_infos = [{"symbol": {"color": color,
+                                              "outline": outline,
+                                              "type": "esriSFS",
+                                              "style": "esriSFSSolid"},
+                                   "label": label,
+                                   "classMaxValue": class_max}
+                                  for class_max, color, label in zip(breaks, colors, labels)]
+
+    @staticmethod
+    def load_style(style_file):
+        with open(style_file, 'r') as json_object:
+            return json.load(json_object)
+
+    def renderer(self, field):
+        # renderer of the field sharing the symbols and stops with every other renderer of the factory
+        return {"renderer": "autocast", #This tells python to use JS autocasting
+                "type": "classBreaks",
+                "field": field,
+                "minValue": self.min_value,
+                "visualVariables": [{"type": "sizeInfo",
+                                     "expression": "view.scale",
+                                     "field": field,
+                                     "stops": self.size_stops}],
+                "classBreakInfos": self.class_break_infos}
+
+
+# basemap of the maps built without the WebMap class, the same default topographic basemap
+DEFAULT_BASEMAP = {
+    "baseMapLayers": [{"id": "defaultBasemap",
+                       "layerType": "ArcGISTiledMapServiceLayer",
+                       "url": "https://services.arcgisonline.com/ArcGIS/rest/services/World_Topo_Map/MapServer",
+                       "visibility": True,
+                       "opacity": 1,
+                       "title": "World Topographic Map"}],
+    "title": "Topographic"
+}
+
+
+def make_operational_layer(layer_id, item, renderer, fields, visibility=False):
+    # operational layer json of a view with its renderer and popup
+    renderer = {k: v for k, v in renderer.items() if k != 'renderer'}
+    return {"id": layer_id,
+            "title": item.title,
+            "url": item.url + '/0',
+            "itemId": item.id,
+            "layerType": "ArcGISFeatureLayer",
+            "visibility": visibility,
+            "opacity": 1,
+            "layerDefinition": {"drawingInfo": {"renderer": renderer}},
+            "popupInfo": {"title": item.title,
+                          "fieldInfos": [{"fieldName": field['name'],
+                                          "label": field.get('alias') or field['name'],
+                                          "isEditable": False,
+                                          "visible": True} for field in fields],
+                          "showAttachments": False}}
+
+
+def build_web_map_json(views_dict, items, renderer_factory, fields, visibility=False, basemap=None):
+    # assemble the whole web map json locally, layers in the order of the views dict
+    return {"operationalLayers": [make_operational_layer('view_' + key, items[item_id], renderer_factory.renderer(key), fields, visibility)
+                                  for key, item_id in views_dict.items()],
+            "baseMap": basemap or DEFAULT_BASEMAP,
+            "spatialReference": {"wkid": 102100, "latestWkid": 3857},
+            "version": "2.10"}
+
+
+def create_map_add_views(views_dict, web_map_title ='web map title', web_map_snippet = 'web map snippet',web_map_tags = 'web map tags', session=None, style=None, single_write=False):
+    # create a map and add the views to it and then set the visibility of all them to false
+    # style is a renderer style dict, a path to a style json file or a RendererFactory
+    # single_write builds the map json locally from a batch of item metadata and creates the item in one write,
+    # with the default topographic basemap and no initial extent, instead of saving a WebMap
+    session = session or get_session()
+    renderer_factory = style if isinstance(style, RendererFactory) else RendererFactory(style)
+    web_map_properties = {'title':web_map_title,
+                        'snippet':web_map_snippet,
+                        'tags':web_map_tags}
 
-    return views_dict
+    if single_write:
+        items = session.get_items(views_dict.values())
+        # the views share the schema of the source layer so the fields are read once
+        fields = items[next(iter(views_dict.values()))].layers[0].properties.fields if views_dict else []
+        map_json = build_web_map_json(views_dict, items, renderer_factory, fields)
+        web_map_properties['type'] = 'Web Map'
+        web_map_properties['text'] = json.dumps(map_json)
+        web_map_item = session.remember_item(session.gis.content.add(web_map_properties))
+        session.invalidate_searches()
+        print_text_log(f"Web map {web_map_title} created with {len(views_dict)} layers")
+        return web_map_item
 
+    from arcgis.mapping import WebMap
 
-def create_map_add_views(views_dict, web_map_title ='web map title', web_map_snippet = 'web map snippet',web_map_tags = 'web map tags'):
-    # create a map and add the views to it and then set the visibility of all them to false
-    
     # create empty map
     web_map = WebMap()
 
     # add views to the map 
     for key, value in views_dict.items():
         print (key)
-        map_renderer = {"renderer": "autocast", #This tells python to use JS autocasting
-                    "type": "classBreaks",
-                    "field":key,
-                    "minValue":1}
-        
-        map_renderer["visualVariables"] = [{"type": "sizeInfo",
-                                            "expression": "view.scale",
-                                            "field": key,
-                                            "stops": [  
-                                                        {
-                                                            "size": 1.5,
-                                                            "value": 50921
-                                                        },
-                                                        {
-                                                            "size": 0.75,
-                                                            "value": 159129
-                                                        },
-                                                        {
-                                                            "size": 0.375,
-                                                            "value": 636517
-                                                        },
-                                                        {
-                                                            "size": 0,
-                                                            "value": 1273034
-                                                        }
-                                                    ]
-                                            }]
-
-        map_renderer["classBreakInfos"] = [{
-                                    "symbol": {
-                                        "color": [
-                                            90,
-                                            106,
-                                            56,
-                                            255
-                                        ],
-                                        "outline": {
-                                            "color": [
-                                                194,
-                                                194,
-                                                194,
-                                                64
-                                            ],
-                                            "width": 0.75,
-                                            "type": "esriSLS",
-                                            "style": "esriSLSSolid"
-                                        },
-                                        "type": "esriSFS",
-                                        "style": "esriSFSSolid"
-                                    },
-                                    "label": "1",
-                                    "classMaxValue": 1
-                                },
-                                {
-                                    "symbol": {
-                                        "color": [
-                                            117,
-                                            144,
-                                            67,
-                                            255
-                                        ],
-                                        "outline": {
-                                            "color": [
-                                                194,
-                                                194,
-                                                194,
-                                                64
-                                            ],
-                                            "width": 0.75,
-                                            "type": "esriSLS",
-                                            "style": "esriSLSSolid"
-                                        },
-                                        "type": "esriSFS",
-                                        "style": "esriSFSSolid"
-                                    },
-                                    "label": "2",
-                                    "classMaxValue": 2
-                                },
-                                {
-                                    "symbol": {
-                                        "color": [
-                                            143,
-                                            178,
-                                            77,
-                                            255
-                                        ],
-                                        "outline": {
-                                            "color": [
-                                                194,
-                                                194,
-                                                194,
-                                                64
-                                            ],
-                                            "width": 0.75,
-                                            "type": "esriSLS",
-                                            "style": "esriSLSSolid"
-                                        },
-                                        "type": "esriSFS",
-                                        "style": "esriSFSSolid"
-                                    },
-                                    "label": "3",
-                                    "classMaxValue": 3
-                                },
-                                {
-                                    "symbol": {
-                                        "color": [
-                                            200,
-                                            223,
-                                            158,
-                                            255
-                                        ],
-                                        "outline": {
-                                            "color": [
-                                                194,
-                                                194,
-                                                194,
-                                                64
-                                            ],
-                                            "width": 0.75,
-                                            "type": "esriSLS",
-                                            "style": "esriSLSSolid"
-                                        },
-                                        "type": "esriSFS",
-                                        "style": "esriSFSSolid"
-                                    },
-                                    "label": "4",
-                                    "classMaxValue": 4
-                                }]
-        web_map.add_layer(gis.content.get(views_dict[key]),
+        map_renderer = renderer_factory.renderer(key)
+        web_map.add_layer(session.get_item(views_dict[key]),
                         {"type": "FeatureLayer",
                         "renderer": map_renderer,
                         "field_name":key,
-                        "minValue":1})
+                        "minValue":renderer_factory.min_value})
     
     # save the map
-    web_map_properties = {'title':web_map_title,
-                        'snippet':web_map_snippet,
-                        'tags':web_map_tags}
-
-    web_map_item = web_map.save(item_properties=web_map_properties)
-
+    web_map_item = session.remember_item(web_map.save(item_properties=web_map_properties))
+    session.invalidate_searches()
 
-    # get json data of the web map
-    map_search = gis.content.search(web_map_title)
-    map_item = map_search[0]
-    map_json = map_item.get_data()
+    # get json data of the web map from the saved item rather than searching by title
+    map_json = web_map_item.get_data()
 
     # set visibility to false
     for layer in map_json['operationalLayers']:
@@ -272,67 +733,189 @@ def create_map_add_views(views_dict, web_map_title ='web map title', web_map_sni
 
     # update the json file of the web map 
     item_properties = {"text": json.dumps(map_json)}
-    item = gis.content.get(map_item.id)
-    item.update(item_properties=item_properties)
+    retry_policy.call('item.update', web_map_item.update, item_properties=item_properties)
 
     return web_map_item
 
+class LayerTree:
+    # group hierarchy built in one pass over the rows, keeping their order
+    # nodes are ordered dicts keyed by the values of each column and the leaves are lists of the last column
+
+    def __init__(self, frame, columns=None):
+        self.columns = list(columns or frame.columns)
+        # like groupby, rows with a missing key are left out
+        frame = frame[self.columns].dropna(subset=self.columns[:-1])
+        if len(self.columns) == 1:
+            self.root = frame[self.columns[0]].tolist()
+            return
+        self.root = collections.OrderedDict()
+        for row in zip(*(frame[x].tolist() for x in self.columns)):
+            node = self.root
+            for key in row[:-2]:
+                node = node.setdefault(key, collections.OrderedDict())
+            node.setdefault(row[-2], []).append(row[-1])
+
+    def node(self, *path):
+        node = self.root
+        for key in path:
+            node = node[key]
+        return node
+
+    def codes(self, *path):
+        # all the leaf values under the path, in order
+        stack = [self.node(*path)]
+        codes = []
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                codes.extend(node)
+            else:
+                stack.extend(reversed(list(node.values())))
+        return codes
+
+    def keys(self, *path):
+        return list(self.node(*path).keys())
+
+    def to_dict(self):
+        # nested dict like recur_dictify made, a single leaf value instead of a list
+        def convert(node):
+            if isinstance(node, list):
+                return node[0] if len(node) == 1 else node
+            return collections.OrderedDict((k, convert(v)) for k, v in node.items())
+        return convert(self.root)
+
+
 def recur_dictify(frame):
     # create the dict strcutre of layer groups
-    d = collections.OrderedDict()
-    if len(frame.columns) == 1:
-        if frame.values.size == 1: return frame.values[0][0]
-        return frame.values.squeeze()
-    grouped = frame.groupby(frame.columns[0], sort=False)
-    for k,g in grouped:
-        d[k] = recur_dictify(g.ix[:,1:]) 
-    return d
-
-def create_group(dict_strcture, template_group_json):
+    return LayerTree(frame).to_dict()
+
+
+def as_code_list(codes):
+    # the codes of a subgroup as a list, recur_dictify gives a single code as a scalar
+    if isinstance(codes, str) or not hasattr(codes, '__iter__'):
+        return [codes]
+    return list(codes)
+
+
+def plan_layer_groups(layer_strcture, map_layer_dict):
+    # desired group and widget tree: group id -> widget id -> label and the map layers to display
+    # layer_strcture is a LayerTree or the dict of recur_dictify
+    if isinstance(layer_strcture, LayerTree):
+        layer_strcture = layer_strcture.root
+    plan = collections.OrderedDict()
+    for group, subgroups in layer_strcture.items():
+        widgets = collections.OrderedDict()
+        for layer_list_index, (layer_list, codes) in enumerate(subgroups.items()):
+            codes = as_code_list(codes)
+            missing = [x for x in codes if x not in map_layer_dict]
+            if len(missing) > 0:
+                print_text_log(f"codes not found in the map for {layer_list}: {str(missing)}")
+            widget_id = 'widgets_LayerList_Widget_' + str(group) + '_' + str(layer_list_index)
+            widgets[widget_id] = {'label': layer_list,
+                                  'layers': {map_layer_dict[x] for x in codes if x in map_layer_dict}}
+        plan[group] = widgets
+    return plan
+
+
+def patch_widget(widget_json, desired, all_layers):
+    # set the label and the display flags of a layer list widget, return the number of values changed
+    changes = 0
+    if widget_json.get('label') != desired['label']:
+        widget_json['label'] = desired['label']
+        changes += 1
+    layer_options = widget_json.setdefault('config', {}).setdefault('layerOptions', {})
+    for lyr in all_layers:
+        layer_options.setdefault(lyr, {})
+    for lyr, options in layer_options.items():
+        display = lyr in desired['layers']
+        if options.get('display') != display:
+            options['display'] = display
+            changes += 1
+    return changes
+
+
+def make_widget_json(widget_id, desired, template_widget_json, all_layers):
+    # create a layer list widget from the template
+    widget_json = copy.deepcopy(template_widget_json)
+    widget_json['id'] = widget_id
+    patch_widget(widget_json, desired, all_layers)
+    return widget_json
+
+
+def make_group_json(group_id, widgets, template_group_json, template_widget_json, all_layers):
+    # create a widget group from the template with a layer list widget per subgroup
+    group_json = copy.deepcopy({k: v for k, v in template_group_json.items() if k != 'widgets'})
+    group_json['label'] = group_id
+    group_json['id'] = group_id
+    group_json['widgets'] = [make_widget_json(widget_id, desired, template_widget_json, all_layers) for widget_id, desired in widgets.items()]
+    return group_json
+
+
+def create_group(dict_strcture, template_group_json, template_widget_json, map_layer_dict):
     # create layer groups and set the visibility 
-    
-    # copy local template
-    base_json = copy.deepcopy(template_group_json)
-    
-    # rename the group
-    base_json['label'] = list(dict_strcture.keys())[0]
-    base_json['id'] = list(dict_strcture.keys())[0] 
-    
-    layer_list_json_group = []
-    for layer_list_index, layer_list in enumerate(dict_strcture[list(dict_strcture.keys())[0]].keys()):
-        # create local copy of the layer list json
-        local_layer_list_json = copy.deepcopy(template_widget_json)
-        
-        # set label of layer _list
-        local_layer_list_json['label'] = layer_list
-        
-        # set id of layer list 
-        local_layer_list_json['id'] = 'widgets_LayerList_Widget_' + str(list(dict_strcture.keys())[0]) + '_' + str(layer_list_index)
-        
-        # get the list of layers to show
-        try: 
-            subgroup_list = [map_layer_dict[x] for x in dict_strcture[list(dict_strcture.keys())[0]][layer_list]]
-
-            # set the visibility according to the dict
-            for lyr in local_layer_list_json['config']['layerOptions']:
-                if lyr in subgroup_list:
-                    local_layer_list_json['config']['layerOptions'][lyr]['display'] = True
-                else: 
-                    local_layer_list_json['config']['layerOptions'][lyr]['display'] = False
-        except:
-            pass
-
-        # add layer group to local list
-        layer_list_json_group.append(local_layer_list_json)
-    
-    # set the base widgets to the local list of groups
-    base_json['widgets'] = layer_list_json_group
-                 
-    return base_json 
+    plan = plan_layer_groups(dict_strcture, map_layer_dict)
+    group_id = next(iter(plan.keys()))
+    return make_group_json(group_id, plan[group_id], template_group_json, template_widget_json, set(map_layer_dict.values()))
+
+
+def sync_layer_groups(app_json, plan, template_group_json, template_widget_json, all_layers):
+    # patch the widget groups of the app json in place to match the plan, return the number of changes
+    changes = 0
+    groups = app_json['widgetPool']['groups']
+    structure_before = [(g.get('id'), [w.get('id') for w in g.get('widgets', [])]) for g in groups]
+    current_groups = {g.get('id'): g for g in groups}
+
+    new_groups = []
+    for group_id, widgets in plan.items():
+        group_json = current_groups.get(group_id)
+        if group_json is None:
+            new_groups.append(make_group_json(group_id, widgets, template_group_json, template_widget_json, all_layers))
+            continue
+        current_widgets = {w.get('id'): w for w in group_json.get('widgets', [])}
+        new_widgets = []
+        for widget_id, desired in widgets.items():
+            if widget_id in current_widgets:
+                changes += patch_widget(current_widgets[widget_id], desired, all_layers)
+                new_widgets.append(current_widgets[widget_id])
+            else:
+                new_widgets.append(make_widget_json(widget_id, desired, template_widget_json, all_layers))
+        group_json['widgets'] = new_widgets
+        new_groups.append(group_json)
+
+    structure_after = [(g.get('id'), [w.get('id') for w in g.get('widgets', [])]) for g in new_groups]
+    if structure_after != structure_before:
+        changes += 1
+    app_json['widgetPool']['groups'] = new_groups
+    return changes
+
+
+def make_map_layer_dict(map_json):
+    # get local ids of the views within the map  
+    map_layer_dict = {}
+    for lyr in map_json['operationalLayers']:
+        if lyr['popupInfo']['fieldInfos'][2]['fieldName'] == 'WardCODE':
+            map_layer_dict[lyr['layerDefinition']['drawingInfo']['renderer']['field']+ '_ward'] = lyr['id']
+        elif lyr['popupInfo']['fieldInfos'][1]['fieldName'] == 'BoroughCOD':
+            map_layer_dict[lyr['layerDefinition']['drawingInfo']['renderer']['field']+ '_borough'] = lyr['id']
+        else:
+            print_text_log('layer_error')
+            print_text_log(lyr['layerDefinition']['drawingInfo']['renderer']['field'])
+            print_text_log(lyr['popupInfo']['fieldInfos'][2]['fieldName'])
+    return map_layer_dict
+
+
+def resolve_item(session, item_or_title):
+    # take an item or a title to search for and return the item
+    if hasattr(item_or_title, 'id'):
+        return item_or_title
+    return session.search_items(item_or_title)[0]
 
 
-def create_layer_groups():
+def create_layer_groups(csv_file_location, web_map, web_app, session=None, incremental=True):
     # create groups of the layers to display them in separate layer lists
+    # web_map and web_app are items or titles to search for
+    # incremental patches only the widgets whose label or display flags changed and skips the upload if nothing changed
+    session = session or get_session()
     # read csv file of the col hierarchy
     df = pd.read_csv(csv_file_location)
 
@@ -343,68 +926,441 @@ def create_layer_groups():
     #  as this order will be the same when adding the views to the map
     df = df.sort_values(by='Order',ascending=False)
 
-    # create the layer dict structure
-    layer_strcture = recur_dictify(df)
+    # create the layer tree structure
+    layer_strcture = LayerTree(df, ['Group', 'SubGroup', 'New_Code'])
 
-    print_text_log(layer_strcture)
+    logger.debug(layer_strcture.root)
 
     # get local ids of the views within the map  
-    map_search = gis.content.search(web_map_title)
-    map_item = map_search[0]
-    map_json = map_item.get_data()
-    map_layer_dict = {}
-    for lyr in map_json['operationalLayers']:
-        if lyr['popupInfo']['fieldInfos'][2]['fieldName'] == 'WardCODE':
-            map_layer_dict[lyr['layerDefinition']['drawingInfo']['renderer']['field']+ '_ward'] = lyr['id']
-        elif lyr['popupInfo']['fieldInfos'][1]['fieldName'] == 'BoroughCOD':
-            map_layer_dict[lyr['layerDefinition']['drawingInfo']['renderer']['field']+ '_borough'] = lyr['id']
-        else:
-            print_text_log('layer_error')
-            print_text_log(lyr['layerDefinition']['drawingInfo']['renderer']['field'])
-            print_text_log(lyr['popupInfo']['fieldInfos'][2]['fieldName'])
-    print_text_log(map_layer_dict)
+    map_layer_dict = make_map_layer_dict(resolve_item(session, web_map).get_data())
+    logger.debug(map_layer_dict)
+    all_layers = set(map_layer_dict.values())
+    plan = plan_layer_groups(layer_strcture, map_layer_dict)
 
     # get the json file from the app 
-    app_search = gis.content.search(web_app_title)
-    app_item = app_search[0]
+    app_item = resolve_item(session, web_app)
     app_json = app_item.get_data()
 
-    # copy the widget group json section
-    groups_json =  copy.deepcopy(app_json['widgetPool']['groups'])
+    # the first group and its first widget are the templates of new groups and widgets
+    template_group_json = copy.deepcopy({k: v for k, v in app_json['widgetPool']['groups'][0].items() if k != 'widgets'})
+    template_widget_json = copy.deepcopy(app_json['widgetPool']['groups'][0]['widgets'][0])
 
-    # copy the widget group json section
-    template_group_json = copy.deepcopy(groups_json[0])
-
-    # copy the widget json section
-    template_widget_json = copy.deepcopy(template_group_json['widgets'][0])
-
-    # create layer groups 
-    app_json['widgetPool']['groups'] = [create_group(layer_strcture, template_widget_json)]
+    if incremental:
+        changes = sync_layer_groups(app_json, plan, template_group_json, template_widget_json, all_layers)
+    else:
+        app_json['widgetPool']['groups'] = [make_group_json(group_id, widgets, template_group_json, template_widget_json, all_layers)
+                                            for group_id, widgets in plan.items()]
+        changes = None
 
     # set the "Keeps map extent and layers visibility while leaving the app." to false
-    app_json['keepAppState'] = False
+    if app_json.get('keepAppState') is not False:
+        app_json['keepAppState'] = False
+        changes = None if changes is None else changes + 1
+
+    if changes == 0:
+        print_text_log("Layer groups are up to date, nothing to upload")
+        return "Done!"
 
     # update web app json file
     item_properties = {"text": json.dumps(app_json)}
-    item = gis.content.get(app_item.id)
-    item.update(item_properties=item_properties)
+    retry_policy.call('item.update', app_item.update, item_properties=item_properties)
+    if changes is not None:
+        print_text_log(f"{changes} layer group values changed")
 
     return "Done!"
 
 def update_func(lyr, target_feature):
-    # func to try the update again after 5 seconds if it fails 
+    # update a single feature, trying again according to the retry policy if it fails
+    return retry_policy.call('edit_features', lyr.layers[0].edit_features, updates = [target_feature])
+
+
+def to_python_value(value):
+    # convert numpy scalars and missing values to plain python for the json payload
+    if pd.isna(value):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def query_call(func, **kwargs):
+    # send a query through the retry policy holding a slot of the request budget
+    return retry_policy.call('query', call_with_budget, func, **kwargs)
+
+
+def iter_feature_pages(pages, layer):
+    # yield the features of the pages and count them
+    fetched = 0
+    for page in pages:
+        metrics.count('rows_fetched', len(page))
+        fetched += len(page)
+        yield from page
+        logger.debug(f"{fetched} features fetched from {layer.url}")
+
+
+def query_all_features(layer, where='1=1', out_fields='*', return_geometry=False, page_size=None, **query_params):
+    # page through the layer and yield every feature matching the condition
+    pages = query_builder.iter_pages(layer, where, out_fields, return_geometry, page_size, call=query_call, **query_params)
+    return iter_feature_pages(pages, layer)
+
+
+def query_features_by_ids(layer, id_col, identifiers, out_fields='*', return_geometry=False, page_size=None, **query_params):
+    # yield the features whose id is one of the identifiers, with batched IN queries
+    pages = query_builder.iter_pages_by_ids(layer, id_col, identifiers, out_fields, return_geometry, page_size, call=query_call, **query_params)
+    return iter_feature_pages(pages, layer)
+
+
+def use_id_lookup(layer, id_col, identifiers, page_size=None):
+    # look the ids up when it takes fewer queries than scanning the layer, counting the layer costs one query
+    clauses = query_builder.in_clauses(id_col, identifiers, query_builder.field_type(layer, id_col))
+    pages = query_builder.page_count(layer, query_builder.count(layer, call=query_call), page_size)
+    logger.debug(f"{len(clauses)} id queries against {pages} pages to scan the layer")
+    return len(clauses) < pages
+
+
+def id_key(value):
+    # the same key for an id whatever type it was read as: 10000, 10000.0, '10000' and np.int64(10000) all give '10000'
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NA:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def id_keys(values):
+    # id_key of every value of a column, as a series of strings
+    values = pd.Series(values)
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'iu':
+        return values.astype(str)
+    return values.map(id_key).astype(object)
+
+
+class FeatureIndex:
+    # local index of the layer attributes, and optionally geometry fingerprints, keyed by the id column
+    # the keys are the ids as strings, see id_key, so ids read as numbers from a csv still match the hosted text ids
+
+    def __init__(self, id_col, oid_field):
+        self.id_col = id_col
+        self.oid_field = oid_field
+        self.features = {}
+        self.fingerprints = {}
+        self.duplicates = {}
+
+    def add(self, attributes, fingerprint=None):
+        # add the attributes of a feature and keep track of the ids used by more than one feature
+        identifier = id_key(attributes[self.id_col])
+        if identifier in self.features:
+            self.duplicates.setdefault(identifier, [self.features[identifier][self.oid_field]])
+            self.duplicates[identifier].append(attributes[self.oid_field])
+        else:
+            self.features[identifier] = attributes
+            if fingerprint is not None:
+                self.fingerprints[identifier] = fingerprint
+
+    def get(self, identifier):
+        return self.features.get(id_key(identifier))
+
+    def fingerprint(self, identifier):
+        return self.fingerprints.get(id_key(identifier))
+
+    def duplicate_oids(self, identifier):
+        return self.duplicates.get(id_key(identifier))
+
+    def find_missing(self, identifiers):
+        # return the ids that are not in the layer
+        return [x for x in dict.fromkeys(identifiers) if id_key(x) not in self.features]
+
+    def report(self, identifiers):
+        # log the missing and duplicate ids before any update is sent
+        missing = self.find_missing(identifiers)
+        if len(missing) > 0:
+            print_text_log(f"{len(missing)} features not found in the layer: {str(missing)}")
+        duplicates = {x: self.duplicate_oids(x) for x in dict.fromkeys(identifiers) if id_key(x) in self.duplicates}
+        if len(duplicates) > 0:
+            print_text_log(f"{len(duplicates)} ids are used by more than one feature, only the first is updated: {str(duplicates)}")
+        return missing, duplicates
+
+    def to_frame(self, columns):
+        # snapshot of the indexed attributes as a dataframe
+        columns = list(dict.fromkeys([self.id_col, self.oid_field] + list(columns)))
+        records = [[attributes.get(col) for col in columns] for attributes in self.features.values()]
+        return pd.DataFrame.from_records(records, columns=columns)
+
+    def __len__(self):
+        return len(self.features)
+
+    def __contains__(self, identifier):
+        return id_key(identifier) in self.features
+
+
+def geometry_fingerprint(rings, precision=6):
+    # hash of the rings quantized to the precision, independent of the ring order, direction and start point
+    ring_hashes = []
+    for ring in rings:
+        coords = np.rint(np.asarray(ring, dtype=float)[:, :2] * 10 ** precision).astype(np.int64)
+        if len(coords) > 1 and not (coords[0] == coords[-1]).all():
+            coords = np.concatenate((coords, coords[:1]))
+        if len(coords) > 3:
+            # shoelace signed area of the closed ring to make the direction the same
+            x, y = coords[:, 0].astype(float), coords[:, 1].astype(float)
+            if np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]) < 0:
+                coords = coords[::-1]
+        coords = coords[:-1]
+        if len(coords) > 0:
+            start = np.lexsort((coords[:, 1], coords[:, 0]))[0]
+            coords = np.concatenate((coords[start:], coords[:start]))
+        ring_hashes.append(hashlib.blake2b(np.ascontiguousarray(coords).tobytes(), digest_size=16).digest())
+    return hashlib.blake2b(b''.join(sorted(ring_hashes)), digest_size=16).hexdigest()
+
+
+def build_feature_index(lyr, id_col, list_of_cols=(), page_size=None, with_geometry=False, precision=6, out_sr=None, identifiers=None, lookup='auto'):
+    # pull the id, object id and requested columns of the whole layer in one paged query
+    # with_geometry keeps a fingerprint of each hosted geometry instead of the geometry itself
+    # with identifiers only those features are needed: lookup 'ids' fetches them with batched IN queries, 'scan' pages
+    # through the whole layer and 'auto' picks the one taking fewer queries
+    layer = lyr.layers[0]
+    oid_field = layer.properties.objectIdField
+    out_fields = ','.join(dict.fromkeys([oid_field, id_col] + list(list_of_cols)))
+    query_params = {} if out_sr is None else {'out_sr': out_sr}
+    index = FeatureIndex(id_col, oid_field)
+    with metrics.phase('query'):
+        if identifiers is not None:
+            identifiers = list(dict.fromkeys(identifiers))
+        if identifiers is not None and (lookup == 'ids' or (lookup == 'auto' and use_id_lookup(layer, id_col, identifiers, page_size))):
+            features = query_features_by_ids(layer, id_col, identifiers, out_fields, with_geometry, page_size, **query_params)
+        else:
+            features = query_all_features(layer, out_fields=out_fields, return_geometry=with_geometry, page_size=page_size, **query_params)
+        for feature in features:
+            fingerprint = None
+            if with_geometry and feature.geometry and 'rings' in feature.geometry:
+                fingerprint = geometry_fingerprint(feature.geometry['rings'], precision)
+            index.add(feature.attributes, fingerprint)
+    print_text_log(f"{len(index)} features indexed using column {id_col} for ID")
+    return index
+
+
+class AdaptiveLimiter:
+    # limit the number of requests in flight, shrinking when throttled and growing back after successes
+
+    def __init__(self, max_limit, min_limit=1, grow_after=5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.grow_after = grow_after
+        self.limit = max_limit
+        self.in_flight = 0
+        self.success_streak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.success_streak += 1
+            if self.success_streak >= self.grow_after and self.limit < self.max_limit:
+                self.limit += 1
+                self.success_streak = 0
+                logger.debug(f"Concurrency increased to {self.limit}")
+                self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            self.success_streak = 0
+            if self.limit > self.min_limit:
+                self.limit = max(self.min_limit, self.limit // 2)
+                print_text_log(f"Service is throttling, concurrency reduced to {self.limit}")
+
+
+def edit_chunk_func(lyr, updates, limiter=None):
+    # send a chunk of updates through the retry policy, holding a slot of the limiter while in flight
+    def send():
+        if limiter is None:
+            return call_with_budget(lyr.layers[0].edit_features, updates=updates, rollback_on_failure=False)
+        limiter.acquire()
+        try:
+            result = call_with_budget(lyr.layers[0].edit_features, updates=updates, rollback_on_failure=False)
+        except Exception as error:
+            if is_throttle_error(error):
+                limiter.on_throttle()
+            raise
+        finally:
+            limiter.release()
+        limiter.on_success()
+        return result
+
+    return retry_policy.call('edit_features', send)
+
+
+def send_chunk(lyr, chunk, limiter=None):
+    # send a chunk and record it as failed instead of stopping the run when the retries run out
+    metrics.count('rows_sent', len(chunk))
+    metrics.count('bytes_sent', len(json.dumps(chunk, default=str)))
     try:
-        logger.debug(lyr)
-        logger.debug(type(lyr))
-        lyr.layers[0].edit_features(updates = [target_feature]) 
-    except RuntimeError:
-        print_text_log('Secondary connection error')
-        time.sleep(5)
-        update_func(lyr, target_feature)
+        return edit_chunk_func(lyr, chunk, limiter)
+    except Exception as error:
+        return {'updateResults': [], 'error': {'description': str(error)}}
+
+
+def collect_chunk_results(chunk, result, oid_field, id_by_oid, updated, failed):
+    # sort the features of a chunk into updated and failed using the edit results
+    results_by_oid = {x.get('objectId'): x for x in result.get('updateResults', [])}
+    missing_result = {'success': False, 'error': result.get('error', {'description': 'no result returned'})}
+    for payload in chunk:
+        oid = payload['attributes'][oid_field]
+        feature_result = results_by_oid.get(oid, missing_result)
+        if feature_result.get('success'):
+            updated.append(id_by_oid[oid])
+        else:
+            failed.append({'id': id_by_oid[oid], 'payload': payload, 'error': feature_result.get('error')})
+
+
+def iter_chunks(items, chunk_size):
+    # split a list or a stream of items into lists of chunk_size items
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def source_fingerprint(source):
+    # short hash telling apart the source files of a job: the path, size and modification time of a file,
+    # or the given text for anything else
+    if isinstance(source, str) and os.path.isfile(source):
+        stat = os.stat(source)
+        source = f"{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.blake2b(str(source).encode(), digest_size=8).hexdigest()
+
+
+class CheckpointJournal:
+    # sqlite journal of the ids applied by a job so a rerun after a crash skips the work already done
+    # call complete at the end of a clean run so the next run of the job starts from the beginning
+    # the journal is kept per source file, a rerun of the job with another file or a changed one starts over
+
+    def __init__(self, journal_file, job_id, source=None):
+        self.journal_file = journal_file
+        self.job_id = job_id
+        self.key = job_id if source is None else f"{job_id}@{source_fingerprint(source)}"
+        self.lock = threading.Lock()
+        if os.path.dirname(journal_file):
+            os.makedirs(os.path.dirname(journal_file), exist_ok=True)
+        self.connection = sqlite3.connect(journal_file, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS applied "
+                                    "(job_id TEXT, identifier TEXT, applied_at REAL, PRIMARY KEY (job_id, identifier))")
+            stale = self.connection.execute("DELETE FROM applied WHERE (job_id = ? OR substr(job_id, 1, ?) = ?) AND job_id != ?",
+                                            (job_id, len(job_id) + 1, job_id + '@', self.key)).rowcount
+        if stale > 0:
+            print_text_log(f"The source of job {job_id} changed, {stale} ids journaled for the previous source are dropped")
+
+    def done(self):
+        # the ids already applied by the job, as normalized id keys
+        with self.lock:
+            rows = self.connection.execute("SELECT identifier FROM applied WHERE job_id = ?", (self.key,)).fetchall()
+        return {x[0] for x in rows}
+
+    def record(self, identifiers):
+        # add the ids of a chunk, committed at once so a crash loses at most the chunk in flight
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO applied VALUES (?, ?, ?)",
+                                        [(self.key, id_key(x), now) for x in identifiers])
+
+    def complete(self):
+        # forget the applied ids of the job once it finished without failures
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM applied WHERE job_id = ?", (self.key,))
+
+    def close(self):
+        self.connection.close()
+
+
+def update_features_chunked(lyr, updates, id_by_oid, chunk_size=1000, max_workers=1, checkpoint=None):
+    # send the updates, a list or a stream, in chunks of edit_features calls, optionally several in flight, and collect the result of each feature
+    # the ids of each chunk are recorded in the checkpoint journal as soon as its results are back
+    oid_field = lyr.layers[0].properties.objectIdField
+    chunk_total = f" out of {(len(updates) + chunk_size - 1) // chunk_size}" if hasattr(updates, '__len__') else ''
+    updated, failed = [], []
+
+    def finish_chunk(chunk, result, chunk_number):
+        updated_before, failed_before = len(updated), len(failed)
+        collect_chunk_results(chunk, result, oid_field, id_by_oid, updated, failed)
+        if checkpoint is not None:
+            checkpoint.record(updated[updated_before:])
+        metrics.count('rows_updated', len(updated) - updated_before)
+        metrics.count('rows_failed', len(failed) - failed_before)
+        log_event('chunk', number=chunk_number, rows=len(chunk), updated=len(updated) - updated_before, failed=len(failed) - failed_before)
+        print_text_log(f"Chunk {chunk_number}{chunk_total} sent, {len(updated)} updated and {len(failed)} failed so far")
+
+    with metrics.phase('edit'):
+        if max_workers <= 1:
+            for chunk_index, chunk in enumerate(iter_chunks(updates, chunk_size)):
+                finish_chunk(chunk, send_chunk(lyr, chunk), chunk_index + 1)
+        else:
+            limiter = AdaptiveLimiter(max_workers)
+            futures = {}
+            done_count = 0
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for chunk in iter_chunks(updates, chunk_size):
+                    futures[executor.submit(send_chunk, lyr, chunk, limiter)] = chunk
+                    # keep only a few chunks queued so a stream is not read ahead into memory
+                    if len(futures) < 2 * max_workers:
+                        continue
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        done_count += 1
+                        finish_chunk(futures.pop(future), future.result(), done_count)
+
+                for future in as_completed(futures):
+                    done_count += 1
+                    finish_chunk(futures[future], future.result(), done_count)
+
+    for failure in failed:
+        logger.debug(f"Feature {failure['id']} failed with {failure['error']}")
+    retry_policy.log_summary()
+    return {'updated': updated, 'failed': failed}
+
+
+def finish_checkpoint(checkpoint, report):
+    # clear the journal of the job once a run ends without failures so the next run starts from the beginning
+    if checkpoint is not None and len(report['failed']) == 0:
+        checkpoint.complete()
+
+
+def skip_checkpointed_rows(csv_df, id_col, checkpoint):
+    # leave out the rows already applied according to the checkpoint journal
+    if checkpoint is None:
+        return csv_df
+    done = checkpoint.done()
+    if len(done) == 0:
+        return csv_df
+    resumed = csv_df[~id_keys(csv_df[id_col]).isin(done).to_numpy()]
+    print_text_log(f"Resuming job {checkpoint.job_id}, {csv_df.shape[0] - resumed.shape[0]} rows already applied are skipped")
+    return resumed
+
+
+def make_update_payload(target, oid_field, row_values):
+    # build the minimal update payload of the object id and the updated columns
+    attributes = {oid_field: target[oid_field]}
+    for update_col, value in row_values.items():
+        attributes[update_col] = to_python_value(value)
+    return {'attributes': attributes}
 
 
 def make_json(shp_file):
     # convert shpfile to Geojson
+    import geopandas as gpd
     gpd.read_file(shp_file).to_file(shp_file[:-4]+".geojson", driver='GeoJSON')
     print_text_log(f"file {shp_file} was converted to geojson")
     return(shp_file[:-4]+".geojson")
@@ -417,37 +1373,353 @@ def get_data_from_json(json_file):
     json_object.close()
     return json_data
 
-def update_geometry(json_data,lyr,id_col= 'Identifier'):
-    # take geometry in Geojson form and convert it to features and update
+def iter_file_features(file_location):
+    # read the features one at a time from a shapefile or Geojson without loading the whole file
+    import fiona
+    with fiona.open(file_location) as source:
+        for feature in source:
+            yield getattr(feature, '__geo_interface__', feature)
+
+
+def ring_area(coords):
+    # shoelace signed area, positive for a counterclockwise ring
+    x, y = coords[:, 0], coords[:, 1]
+    return (np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+
+def orient_ring(ring, clockwise):
+    # ring coordinates turned to the direction, Esri wants the outer rings clockwise and the holes counterclockwise
+    coords = np.asarray(ring, dtype=float)
+    if len(coords) > 3 and (ring_area(coords) < 0) != clockwise:
+        coords = coords[::-1]
+    return coords.tolist()
+
+
+def esri_rings(geometry):
+    # convert Geojson polygon or multipolygon coordinates to Esri rings, with the outer rings clockwise
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    return [orient_ring(ring, ring_index == 0) for polygon in polygons for ring_index, ring in enumerate(polygon)]
+
+
+def esri_ring_arrays(geometries, simplify=None, decimals=None):
+    # flatten an array of shapely polygons and multipolygons into one coordinate array with the Esri ring order and direction
+    # returns the coordinates, the offsets of the rings in the coordinates and the offsets of each geometry in the rings
+    # simplify is the tolerance in the units of the coordinates, decimals rounds the coordinates to shrink the payload
+    import shapely
+    if len(geometries) == 0:
+        return np.empty((0, 2)), np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    types = set(shapely.get_type_id(geometries).tolist()) - {3, 6}
+    if types:
+        raise ValueError(f"Only polygons and multipolygons can be converted, found geometry type ids {sorted(types)}")
+    if simplify:
+        geometries = shapely.simplify(geometries, simplify, preserve_topology=True)
+
+    geometry_type, coords, offsets = shapely.to_ragged_array(geometries)
+    coords = coords[:, :2]
+    ring_offsets, part_offsets = offsets[0].astype(np.int64), offsets[1].astype(np.int64)
+    geometry_offsets = part_offsets if len(offsets) == 2 else part_offsets[offsets[2]]
+    if decimals is not None:
+        coords = np.round(coords, decimals)
+
+    # signed area of every ring in one pass, relative to its first point to keep the precision of large coordinates
+    starts, ends = ring_offsets[:-1], ring_offsets[1:]
+    lengths = ends - starts
+    ring_of_coord = np.repeat(np.arange(len(starts)), lengths)
+    local = coords - coords[starts][ring_of_coord]
+    cross = local[:-1, 0] * local[1:, 1] - local[1:, 0] * local[:-1, 1]
+    cross[ends[(ends > 0) & (ends < len(coords))] - 1] = 0
+    area = np.zeros(len(starts))
+    filled = lengths > 0
+    area[filled] = np.add.reduceat(np.append(cross, 0), starts[filled])
+
+    # Esri wants the outer ring of each part clockwise and the holes counterclockwise
+    exterior = np.zeros(len(starts), dtype=bool)
+    exterior[part_offsets[:-1][part_offsets[:-1] < len(starts)]] = True
+    reverse = np.where(exterior, area > 0, area < 0)[ring_of_coord]
+    positions = np.arange(len(coords))
+    positions[reverse] = (starts + ends - 1)[ring_of_coord][reverse] - positions[reverse]
+    return coords[positions], ring_offsets, geometry_offsets
+
+
+def rings_from_arrays(coords, ring_offsets, geometry_offsets):
+    # nested lists of the rings of each geometry for the json payloads
+    coord_list = coords.tolist()
+    rings = [coord_list[start:end] for start, end in zip(ring_offsets[:-1].tolist(), ring_offsets[1:].tolist())]
+    return [rings[start:end] for start, end in zip(geometry_offsets[:-1].tolist(), geometry_offsets[1:].tolist())]
+
+
+def convert_wkb_geometries(wkb_geometries, simplify=None, decimals=None):
+    # process pool entry point, the geometries come in as wkb and go back as arrays which are cheap to send
+    import shapely
+    return esri_ring_arrays(shapely.from_wkb(wkb_geometries), simplify, decimals)
+
+
+def convert_geometries(geometries, simplify=None, decimals=None, processes=0, chunk_size=50000):
+    # Esri geometries of an array of shapely polygons and multipolygons, None for missing or empty ones
+    # with processes the flattening runs in a process pool, chunk_size geometries at a time
+    import shapely
+    geometries = np.asarray(geometries, dtype=object)
+    converted = [None] * len(geometries)
+    present = np.flatnonzero(~(shapely.is_missing(geometries) | shapely.is_empty(geometries)))
+    geometries = geometries[present]
+    if processes <= 1 or len(geometries) <= chunk_size:
+        ring_lists = rings_from_arrays(*esri_ring_arrays(geometries, simplify, decimals))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        chunks = [shapely.to_wkb(geometries[start:start + chunk_size]) for start in range(0, len(geometries), chunk_size)]
+        ring_lists = []
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for arrays in executor.map(convert_wkb_geometries, chunks, itertools.repeat(simplify), itertools.repeat(decimals)):
+                ring_lists.extend(rings_from_arrays(*arrays))
+    for position, rings in zip(present.tolist(), ring_lists):
+        converted[position] = {'rings': rings}
+    return converted
+
+
+def convert_geodataframe(gdf, simplify=None, decimals=None, processes=0, chunk_size=50000):
+    # Esri geometries of the rows of the GeoDataFrame
+    with metrics.phase('convert'):
+        return convert_geometries(gdf.geometry.values, simplify, decimals, processes, chunk_size)
+
+
+def iter_geodataframe_features(gdf, id_col, simplify=None, decimals=None, processes=0):
+    # features of the GeoDataFrame with their Esri geometry, converted up front in one vectorized stage,
+    # a missing or empty shape comes as a None geometry
+    converted = convert_geodataframe(gdf, simplify, decimals, processes)
+    for identifier, geometry in zip(gdf[id_col].tolist(), converted):
+        yield {'properties': {id_col: identifier}, 'geometry': geometry}
+
+
+def make_geometry_updates(features, index, id_col, id_by_oid, missing, unchanged, skip_unchanged=True, precision=6, done=(), empty=None):
+    # turn a stream of Geojson features into update payloads as they are read, skipping the shapes which did not change,
+    # the ids in done and the features without a geometry, whose ids go to empty
+    empty = [] if empty is None else empty
+    for item in features:
+        identifier = item['properties'][id_col]
+        if id_key(identifier) in done:
+            continue
+        target = index.get(identifier)
+        if target is None:
+            missing.append(identifier)
+            continue
+        if not item.get('geometry') or not (item['geometry'].get('rings') or item['geometry'].get('coordinates')):
+            empty.append(identifier)
+            continue
+        rings = item['geometry']['rings'] if 'rings' in item['geometry'] else esri_rings(item['geometry'])
+        if skip_unchanged and index.fingerprint(identifier) is not None:
+            if geometry_fingerprint(rings, precision) == index.fingerprint(identifier):
+                unchanged.append(identifier)
+                continue
+        oid = target[index.oid_field]
+        id_by_oid[oid] = identifier
+        yield {'attributes': {index.oid_field: oid},
+               'geometry': {'rings': rings}}
+
+
+def update_geometry(json_data,lyr,id_col= 'Identifier', chunk_size = 1000, index = None, max_workers = 1, skip_unchanged = True, precision = 6, out_sr = None, checkpoint = None,
+                    load = False, simplify = None, decimals = None, processes = 0):
+    # take geometry as a Geojson dict, a stream of Geojson features, a GeoDataFrame or a shapefile/Geojson path and update it in chunks
+    # skip_unchanged compares quantized fingerprints with the hosted geometry, out_sr should match the local coordinates
+    # a GeoDataFrame, or a path with load, is converted in one vectorized stage, split across processes for large files,
+    # which can also simplify the shapes by a tolerance and round the coordinates to decimals; paths are streamed otherwise
     print_text_log(f"Updating geometry using column {id_col} for ID")
-    for index, item in enumerate(json_data['features']):
-        condition = f"{id_col} = '{item['properties'][id_col]}'"
-        logger.debug (f"selection condition is {condition}")
-
-        target_feature = deepcopy(lyr.layers[0].query(where = condition).features[0])
-        target_feature.geometry['rings'] = item['geometry']['coordinates']
-        
-        try: 
-            update_func(lyr, target_feature)
-        except RuntimeError:
-            print_text_log('Primary connection error')
-            time.sleep(5)
-            update_func(lyr, target_feature)
-
-        print_text_log(f"feature {item['properties'][id_col]}, {index+1} out of {len(json_data['features'])} was updated")
-
-
-def find_extra_fields(lyr, df):
+    if isinstance(json_data, str) and load:
+        import geopandas as gpd
+        with metrics.phase('read_file'):
+            json_data = gpd.read_file(json_data)
+    # the ids are known up front for a GeoDataFrame or a Geojson dict, so only their features need to be indexed
+    identifiers = None
+    if hasattr(json_data, 'geometry') and hasattr(json_data, 'columns'):
+        identifiers = json_data[id_col]
+        features = iter_geodataframe_features(json_data, id_col, simplify, decimals, processes)
+    elif isinstance(json_data, str):
+        features = iter_file_features(json_data)
+    elif isinstance(json_data, dict):
+        features = json_data['features']
+        identifiers = [x['properties'][id_col] for x in features]
+    else:
+        features = json_data
+    if index is None:
+        index = build_feature_index(lyr, id_col, with_geometry=skip_unchanged, precision=precision, out_sr=out_sr, identifiers=identifiers)
+
+    done = set() if checkpoint is None else checkpoint.done()
+    if len(done) > 0:
+        print_text_log(f"Resuming job {checkpoint.job_id}, {len(done)} features already applied are skipped")
+
+    id_by_oid, missing, unchanged, empty = {}, [], [], []
+    updates = make_geometry_updates(features, index, id_col, id_by_oid, missing, unchanged, skip_unchanged, precision, done, empty)
+    report = update_features_chunked(lyr, updates, id_by_oid, chunk_size=chunk_size, max_workers=max_workers, checkpoint=checkpoint)
+    finish_checkpoint(checkpoint, report)
+
+    if len(missing) > 0:
+        print_text_log(f"{len(missing)} features not found in the layer: {str(missing)}")
+    if len(empty) > 0:
+        print_text_log(f"{len(empty)} features have no geometry and were skipped: {str(empty)}")
+    duplicates = {x: index.duplicate_oids(x) for x in id_by_oid.values() if index.duplicate_oids(x) is not None}
+    if len(duplicates) > 0:
+        print_text_log(f"{len(duplicates)} ids are used by more than one feature, only the first is updated: {str(duplicates)}")
+    report['missing'] = missing
+    report['duplicates'] = duplicates
+    report['unchanged'] = unchanged
+    report['empty'] = empty
+
+    print_text_log(f"{len(report['updated'])} geometries updated, {len(report['failed'])} failed, {len(unchanged)} unchanged and {len(empty)} without geometry out of {len(id_by_oid) + len(missing) + len(unchanged) + len(empty)} features")
+    # the features are read and compared while the chunks are sent, so their time is part of the edit phase
+    report['metrics'] = metrics.finish('update_geometry')
+    return report
+
+
+# columns of the update files which are never added to the layer
+IGNORED_COLUMNS = ['shape_area', 'shape_length', 'date_unix']
+# string field lengths, the smallest one holding the longest value of a column is used
+STRING_LENGTHS = [50, 100, 255, 500, 1000, 2000, 4000, 8000]
+
+
+def string_length(series):
+    # length of the string field holding the longest value with room to grow
+    longest = series.dropna().astype(str).str.len().max()
+    longest = 0 if pd.isna(longest) else int(longest)
+    return next((x for x in STRING_LENGTHS if x >= longest * 2), max(STRING_LENGTHS[-1], longest))
+
+
+def infer_field_type(dtype, series=None):
+    # esri field type of a pandas dtype, the values of the series widen the integers beyond 32 bits when needed
+    # integers are never narrowed below esriFieldTypeInteger as today's small values say nothing about later ones
+    if pd.api.types.is_bool_dtype(dtype):
+        return "esriFieldTypeSmallInteger"
+    if pd.api.types.is_integer_dtype(dtype):
+        if series is not None and series.notna().any():
+            low, high = int(series.min()), int(series.max())
+        else:
+            info = np.iinfo(getattr(dtype, 'numpy_dtype', dtype))
+            low, high = info.min, info.max
+        if -2 ** 31 <= low and high < 2 ** 31:
+            return "esriFieldTypeInteger"
+        # beyond 32 bits a double keeps the value on every service version
+        return "esriFieldTypeDouble"
+    if pd.api.types.is_float_dtype(dtype):
+        return "esriFieldTypeSingle" if dtype == np.float32 else "esriFieldTypeDouble"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "esriFieldTypeDate"
+    if pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+        return "esriFieldTypeString"
+    return None
+
+
+def make_field(name, field_type, length=None):
+    # definition of a nullable editable field
+    field = {"name": name,
+             "type": field_type,
+             "alias": name,
+             "sqlType": "sqlTypeOther",
+             "nullable": True,
+             "editable": True,
+             "visible": True,
+             "domain": None,
+             "defaultValue": None}
+    if field_type == "esriFieldTypeString":
+        field["length"] = length or 800
+    return field
+
+
+def infer_fields(df, columns=None):
+    # field definitions of the columns of the dataframe, all of them by default
+    fields = []
+    for col in (df.columns if columns is None else columns):
+        field_type = infer_field_type(df[col].dtype, df[col])
+        if field_type is None:
+            print_text_log(f"Column {col} of type {df[col].dtype} has no matching field type and is not added")
+            continue
+        fields.append(make_field(col, field_type, string_length(df[col]) if field_type == "esriFieldTypeString" else None))
+    return fields
+
+
+class LayerSchema:
+    # cached field list of a layer, new fields are added in one definition change and waited for before returning
+
+    def __init__(self, lyr):
+        self.layer = lyr.layers[0]
+        self.lock = threading.Lock()
+        self.fields = self.read_fields()
+
+    def read_fields(self, refresh=False):
+        # refresh clears the cached service definition so fields added since are listed
+        manager = self.layer.manager
+        if refresh and hasattr(manager, 'refresh'):
+            manager.refresh()
+        return {field['name']: dict(field) for field in manager.properties.fields}
+
+    @property
+    def field_names(self):
+        return list(self.fields.keys())
+
+    def field_type(self, name):
+        field = next((x for x in self.fields.values() if x['name'].lower() == name.lower()), None)
+        return None if field is None else field['type']
+
+    def new_columns(self, df):
+        # columns of the dataframe which are not fields of the layer, field names are not case sensitive
+        # and of columns differing only by case the first one is kept
+        existing = {x.lower() for x in self.fields}
+        columns = {}
+        for col in df.columns:
+            if col.lower() not in existing and col.lower() not in IGNORED_COLUMNS:
+                columns.setdefault(col.lower(), col)
+        return list(columns.values())
+
+    def add(self, new_fields, timeout=60):
+        # add the fields in one add_to_definition call and wait until the layer lists them all
+        with self.lock:
+            existing = {x.lower() for x in self.fields}
+            unique = {}
+            for field in new_fields:
+                if field['name'].lower() not in existing:
+                    unique.setdefault(field['name'].lower(), field)
+            new_fields = list(unique.values())
+            if len(new_fields) == 0:
+                return []
+            logger.debug(new_fields)
+            with metrics.phase('schema'):
+                retry_policy.call('add_to_definition', self.layer.manager.add_to_definition, {'fields': new_fields})
+                names = [x['name'] for x in new_fields]
+                start, attempt = time.monotonic(), 0
+                while True:
+                    self.fields = self.read_fields(refresh=True)
+                    listed = {x.lower() for x in self.fields}
+                    pending = [x for x in names if x.lower() not in listed]
+                    if len(pending) == 0:
+                        break
+                    if time.monotonic() - start > timeout:
+                        raise RuntimeError(f"Fields {pending} were not added to the layer after {timeout} seconds")
+                    time.sleep(backoff_delay(attempt, base=0.5, cap=5))
+                    attempt += 1
+            print_text_log(f"{len(names)} fields added to the layer: {str(names)}")
+            return names
+
+    def sync(self, df, timeout=60):
+        # add the columns of the dataframe missing from the layer, with types inferred from the data
+        new_columns = self.new_columns(df)
+        if len(new_columns) == 0:
+            return []
+        print_text_log(f"New columns found are {str(new_columns)}")
+        return self.add(infer_fields(df, new_columns), timeout)
+
+
+def layer_schema(lyr, session=None):
+    # the schema of the layer, read once and cached by the session
+    session = session or get_session()
+    layer = lyr.layers[0]
+    return session.cached(('schema', layer.url), lambda: LayerSchema(lyr))
+
+
+def sync_schema(lyr, df, session=None, timeout=60):
+    # add the columns of the dataframe missing from the layer before it is used for updates
+    return layer_schema(lyr, session).sync(df, timeout)
+
+
+def find_extra_fields(lyr, df, session=None):
     # find the extra fields which are added to the feature
-    field_list = []
-    for field in lyr.layers[0].manager.properties.fields:
-        field_list.append(field['name'])
-    df_fields = set(df.keys())
-
-    new_fields_list = df_fields.difference(set(field_list))
-    
-    
-    new_fields_list = [x for x in new_fields_list if x.lower() not in ['shape_area', 'shape_length', 'date_unix']]
+    new_fields_list = layer_schema(lyr, session).new_columns(df)
     if len(new_fields_list) == 0: 
         return 0
     print_text_log(f"New columns found are {str(new_fields_list)}")
@@ -458,56 +1730,30 @@ def find_extra_fields(lyr, df):
     return new_fields_type_dict
 
 
-def make_new_field(new_fields_type_dict):
-    # create the dictionary required for the new fields 
+def make_new_field(new_fields_type_dict, df=None):
+    # create the dictionary required for the new fields, sized from the data of df if given
     new_field_list = []
-    string_template = {
-            "name": "name",
-            "type": "esriFieldTypeString",
-            "alias": "alias",
-            "sqlType": "sqlTypeOther",
-            "length": 800,
-            "nullable": True,
-            "editable": True,
-            "visible": True,
-            "domain": None,
-            "defaultValue": None
-            }
-    numerical_template = {
-            "name": "name",
-            "type": "esriFieldTypeDouble",
-            "alias": "alias",
-            "sqlType": "sqlTypeOther",
-            "nullable": True,
-            "editable": True,
-            "visible": True,
-            "domain": None,
-            "defaultValue": None
-            }
     for field_name, field_type in new_fields_type_dict.items():
-        if field_type == 'O':
-            field_template = deepcopy(string_template)
-            field_template["name"] = field_name
-            field_template["alias"] = field_name
-            new_field_list.append(field_template)
-        elif field_type in ['int64', 'float64', 'int32', 'float32']:
-            field_template = deepcopy(numerical_template)
-            field_template["name"] = field_name
-            field_template["alias"] = field_name
-            new_field_list.append(field_template)
+        series = None if df is None else df[field_name]
+        esri_type = infer_field_type(field_type, series)
+        if esri_type is None:
+            print_text_log(f"Column {field_name} of type {field_type} has no matching field type and is not added")
+            continue
+        length = string_length(series) if series is not None and esri_type == "esriFieldTypeString" else None
+        new_field_list.append(make_field(field_name, esri_type, length))
     return new_field_list
 
 
-def add_fields(lyr, new_field_list):
-    # add now fields to the feature
-    logger.debug(new_field_list)
-    lyr.layers[0].manager.add_to_definition({'fields':new_field_list})
+def add_fields(lyr, new_field_list, session=None):
+    # add now fields to the feature in one call and wait until they can be used
+    return layer_schema(lyr, session).add(new_field_list)
 
 
-def find_feature(search_text):
+def find_feature(search_text, session=None):
     # take a string and return the related layer
+    session = session or get_session()
     
-    layer_search = gis.content.search(search_text, item_type="Feature Layer Collection")
+    layer_search = session.search_items(search_text, item_type="Feature Layer Collection")
 
     if len(layer_search) < 1:
         print_text_log ('Search Empty!')
@@ -520,66 +1766,442 @@ def find_feature(search_text):
         found_names.append('{}; {}; {}'.format(str(item.title), str(item.type), str(item.id)))
     logger.debug(str(found_names))
 
-    lyr = FeatureLayerCollection.fromitem(layer_search[0])
+    lyr = session.layer_collection(layer_search[0])
     return lyr
 
-def read_update_csv(csv_file):
-    # read csv file and 
-    csv_df = pd.read_csv(csv_file)
-    csv_df['DATE_UNIX'] = pd.to_datetime(csv_df['Survey_Dat']).astype('int64')//10**9
+# format of the survey dates: Survey_Dat is the date field of the survey shapefile, exported as ISO dates like
+# 2019-05-21 (a time may follow); exports written with another format pass date_format, e.g. '%d/%m/%Y'
+DATE_FORMAT = 'ISO8601'
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.feather', '.arrow')
+
+
+def has_pyarrow():
+    import importlib.util
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def update_csv_columns(id_col=None, columns=None, date_col='Survey_Dat'):
+    # the columns to read, None to read all of them
+    if id_col is None and not columns:
+        return None
+    return list(dict.fromkeys([x for x in [id_col, date_col] if x is not None] + list(columns or [])))
+
+
+def update_csv_dtypes(id_col=None, dtypes=None):
+    # the explicit column types, the ids are read as text unless given so 00123 keeps its zeros
+    dtypes = dict(dtypes or {})
+    if id_col is not None:
+        dtypes.setdefault(id_col, str)
+    return dtypes or None
+
+
+def parquet_cache(csv_file, dtypes=None):
+    # convert the csv to parquet once next to it and reuse the conversion until the csv changes
+    # the types are part of the cache name, a conversion with other types is a different cache
+    cache_file = csv_file + '.cache.parquet'
+    if dtypes:
+        key = json.dumps(sorted((str(k), getattr(v, '__name__', str(v))) for k, v in dtypes.items()))
+        cache_file = csv_file + '.' + hashlib.blake2b(key.encode(), digest_size=8).hexdigest() + '.cache.parquet'
+    if not os.path.exists(cache_file) or os.path.getmtime(cache_file) < os.path.getmtime(csv_file):
+        with metrics.phase('parquet_conversion'):
+            pd.read_csv(csv_file, dtype=dtypes, engine='pyarrow' if has_pyarrow() else 'c').to_parquet(cache_file, index=False)
+        print_text_log(f"file {csv_file} was converted to parquet in {cache_file}")
+    return cache_file
+
+
+def add_date_unix(csv_df, date_col='Survey_Dat', date_format=None):
+    # parse the survey date with a fixed format into seconds since the epoch, missing dates become NaN
+    if date_col is None:
+        return csv_df
+    dates = pd.to_datetime(csv_df[date_col], format=date_format)
+    csv_df['DATE_UNIX'] = (dates - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
     return csv_df
 
-def update_new_survey(lyr, csv_df, id_col = 'Identifier', list_of_update_col = ['FASCIA', 'ACTIVITY', 'USE_CLASS']):
-    # update row if survey is more recent than last edit
-    print_text_log(f"Updating columns {str(list_of_update_col)}, and using column {id_col} for ID")
-    update_count, skip_count = 0, 0
-    for index, row in csv_df.iterrows():
-        condition = f"{id_col} = '{row[id_col]}'"
-        logger.debug (f"selection condition is {condition}")
-        target_feature = deepcopy(lyr.layers[0].query(where = condition).features[0])
-        if target_feature.attributes['EditDate'] < row['DATE_UNIX']:
-            for update_col in list_of_update_col:
-                target_feature.attributes[update_col] = row[update_col]
-
-            try: 
-                update_func(lyr, target_feature)
-            except RuntimeError:
-                print_text_log('Primary connection error')
-                time.sleep(5)
-                update_func(lyr, target_feature)
-
-
-            print_text_log(f"Feature {row[id_col]}, {index+1} out of {csv_df.shape[0]} is updated")
-            update_count += 1
-        else: 
-            print_text_log(f"Feature {row[id_col]}, {index+1} out of {csv_df.shape[0]} is skipped")
-            skip_count += 1
-    
-    print_text_log(f"{update_count} features updated, and {skip_count} features skipped out of {csv_df.shape[0]} features")
 
+def read_update_csv(csv_file, id_col=None, columns=None, date_col='Survey_Dat', date_format=None, dtypes=None, cache_parquet=False):
+    # read the update file, csv, parquet or arrow, keeping only the id, date and update columns if given
+    # dtypes maps columns to explicit types instead of inferring them, the id column is text unless given,
+    # date_col None skips the survey date
+    usecols = update_csv_columns(id_col, columns, date_col)
+    dtypes = update_csv_dtypes(id_col, dtypes)
+    date_format = date_format or DATE_FORMAT
+    with metrics.phase('read_csv'):
+        if cache_parquet and csv_file.lower().endswith('.csv'):
+            csv_file = parquet_cache(csv_file, dtypes)
+        if csv_file.lower().endswith(PARQUET_EXTENSIONS):
+            csv_df = pd.read_parquet(csv_file, columns=usecols)
+        elif csv_file.lower().endswith(ARROW_EXTENSIONS):
+            csv_df = pd.read_feather(csv_file, columns=usecols)
+        else:
+            csv_df = pd.read_csv(csv_file, usecols=usecols, dtype=dtypes, engine='pyarrow' if has_pyarrow() else 'c')
+        if dtypes and not csv_file.lower().endswith('.csv'):
+            csv_df = csv_df.astype(dtypes)
+        csv_df = add_date_unix(csv_df, date_col, date_format)
+    metrics.count('rows_read', csv_df.shape[0])
+    return csv_df
 
-def update_all(lyr, csv_df, id_col = 'Identifier', list_of_update_col = ['Name', 'Class', 'activity']):
+
+def iter_chunks_frame(df, chunk_size):
+    # split a dataframe in frames of chunk_size rows
+    for start in range(0, df.shape[0], chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+def iter_update_csv(csv_file, chunk_size=100000, id_col=None, columns=None, date_col='Survey_Dat', date_format=None, dtypes=None, cache_parquet=False):
+    # read the update file in frames of chunk_size rows, each ready for the update functions with a shared index
+    usecols = update_csv_columns(id_col, columns, date_col)
+    dtypes = update_csv_dtypes(id_col, dtypes)
+    date_format = date_format or DATE_FORMAT
+    if cache_parquet and csv_file.lower().endswith('.csv'):
+        csv_file = parquet_cache(csv_file, dtypes)
+    if csv_file.lower().endswith(PARQUET_EXTENSIONS):
+        import pyarrow.parquet as pq
+        frames = (batch.to_pandas() for batch in pq.ParquetFile(csv_file).iter_batches(batch_size=chunk_size, columns=usecols))
+    elif csv_file.lower().endswith(ARROW_EXTENSIONS):
+        frames = iter_chunks_frame(pd.read_feather(csv_file, columns=usecols), chunk_size)
+    else:
+        frames = pd.read_csv(csv_file, usecols=usecols, dtype=dtypes, chunksize=chunk_size)
+    while True:
+        with metrics.phase('read_csv'):
+            csv_df = next(frames, None)
+            if csv_df is None:
+                return
+            if dtypes and not csv_file.lower().endswith('.csv'):
+                csv_df = csv_df.astype(dtypes)
+            csv_df = add_date_unix(csv_df, date_col, date_format)
+        metrics.count('rows_read', csv_df.shape[0])
+        yield csv_df
+
+
+def plan_survey_updates(csv_df, index, id_col = 'Identifier', list_of_update_col = ['FASCIA', 'ACTIVITY', 'USE_CLASS'], date_col = 'DATE_UNIX'):
+    # join the survey to the layer snapshot and find in one pass the rows which are newer and the columns which changed
+    # the ids are joined on their normalized keys, the csv and the layer may hold them as different types
+    list_of_update_col = list(list_of_update_col)
+    snapshot = index.to_frame(['EditDate'] + list_of_update_col).drop(columns=[id_col])
+    snapshot.insert(0, '_id_key', list(index.features.keys()))
+    survey = csv_df[[id_col, date_col] + list_of_update_col].assign(_id_key=id_keys(csv_df[id_col]).to_numpy())
+    merged = survey.merge(snapshot, on='_id_key', how='inner', suffixes=('', '_current'))
+
+    # hosted dates come back in epoch milliseconds and the survey date is in epoch seconds
+    newer = (pd.to_numeric(merged['EditDate']) // 1000 < merged[date_col]).to_numpy()
+    new_values = merged[list_of_update_col]
+    current_values = merged[[x + '_current' for x in list_of_update_col]].set_axis(list_of_update_col, axis=1)
+    changed = new_values.ne(current_values) & ~(new_values.isna() & current_values.isna())
+    changed = pd.DataFrame(changed.to_numpy(dtype=bool) & newer[:, None], columns=list_of_update_col, index=merged.index)
+    changed_any = changed.any(axis=1).to_numpy()
+
+    counts = {'rows': int(csv_df.shape[0]),
+              'missing': int((~survey['_id_key'].isin(snapshot['_id_key'])).sum()),
+              'not_newer': int((~newer).sum()),
+              'unchanged': int((newer & ~changed_any).sum()),
+              'to_update': int(changed_any.sum()),
+              'columns': {k: int(v) for k, v in changed.sum().items()}}
+
+    return {'id_col': id_col,
+            'oid_field': index.oid_field,
+            'columns': list_of_update_col,
+            'changes': merged.loc[changed_any, [id_col, index.oid_field] + list_of_update_col],
+            'changed': changed[changed_any],
+            'counts': counts}
+
+
+def make_plan_payloads(plan):
+    # build the update payloads carrying only the changed columns of each row
+    oid_field = plan['oid_field']
+    updates, id_by_oid = [], {}
+    for record, mask in zip(plan['changes'].to_dict('records'), plan['changed'].to_numpy()):
+        attributes = {oid_field: to_python_value(record[oid_field])}
+        for update_col, is_changed in zip(plan['columns'], mask):
+            if is_changed:
+                attributes[update_col] = to_python_value(record[update_col])
+        updates.append({'attributes': attributes})
+        id_by_oid[attributes[oid_field]] = record[plan['id_col']]
+    return updates, id_by_oid
+
+
+def update_new_survey(lyr, csv_df, id_col = 'Identifier', list_of_update_col = ['FASCIA', 'ACTIVITY', 'USE_CLASS'], chunk_size = 1000, index = None, dry_run = False, max_workers = 1, checkpoint = None):
+    # update row if survey is more recent than last edit and the values actually changed
+    print_text_log(f"Updating columns {str(list_of_update_col)}, and using column {id_col} for ID")
+    csv_df = skip_checkpointed_rows(csv_df, id_col, checkpoint)
+    if index is None:
+        index = build_feature_index(lyr, id_col, ['EditDate'] + list(list_of_update_col), identifiers=csv_df[id_col])
+    missing, duplicates = index.report(csv_df[id_col])
+
+    with metrics.phase('diff'):
+        plan = plan_survey_updates(csv_df, index, id_col, list_of_update_col)
+    counts = plan['counts']
+    print_text_log(f"Plan: {counts['to_update']} features to update, {counts['unchanged']} unchanged, {counts['not_newer']} not newer and {counts['missing']} missing out of {counts['rows']} rows")
+    print_text_log(f"Changed values per column: {str(counts['columns'])}")
+
+    if dry_run:
+        return {'plan': plan, 'updated': [], 'failed': [], 'missing': missing, 'duplicates': duplicates,
+                'metrics': metrics.finish('update_new_survey')}
+
+    with metrics.phase('diff'):
+        updates, id_by_oid = make_plan_payloads(plan)
+    report = update_features_chunked(lyr, updates, id_by_oid, chunk_size=chunk_size, max_workers=max_workers, checkpoint=checkpoint)
+    finish_checkpoint(checkpoint, report)
+    report['plan'] = plan
+    report['skipped'] = counts['unchanged'] + counts['not_newer']
+    report['missing'] = missing
+    report['duplicates'] = duplicates
+
+    print_text_log(f"{len(report['updated'])} features updated, {len(report['failed'])} failed, and {report['skipped']} features skipped out of {csv_df.shape[0]} features")
+    report['metrics'] = metrics.finish('update_new_survey')
+    return report
+
+
+def update_all(lyr, csv_df, id_col = 'Identifier', list_of_update_col = ['Name', 'Class', 'activity'], chunk_size = 1000, index = None, max_workers = 1, checkpoint = None):
     # update all rows disregarding the survey
     print_text_log(f"Updating columns {str(list_of_update_col)}, and using column {id_col} for ID")
-    for index, row in csv_df.iterrows():
-        condition = f"{id_col} = '{row[id_col]}'"
-        logger.debug (f"selection condition is {condition}")
-        target_feature = deepcopy(lyr.layers[0].query(where = condition).features[0])
-        
-
-        for update_col in list_of_update_col:
-            target_feature.attributes[update_col] = row[update_col]
-
-        
-        try: 
-            update_func(lyr, target_feature)
-        except RuntimeError:
-            print_text_log('Primary connection error')
-            time.sleep(5)
-            update_func(lyr, target_feature)
-
-
-        print_text_log(f"Feature {row[id_col]}, {index+1} out of {csv_df.shape[0]} is updated")
+    csv_df = skip_checkpointed_rows(csv_df, id_col, checkpoint)
+    if index is None:
+        index = build_feature_index(lyr, id_col, list_of_update_col, identifiers=csv_df[id_col])
+    missing, duplicates = index.report(csv_df[id_col])
+
+    updates, id_by_oid = [], {}
+    with metrics.phase('diff'):
+        for row in csv_df[[id_col] + list(list_of_update_col)].to_dict('records'):
+            target = index.get(row[id_col])
+            if target is None:
+                continue
+            updates.append(make_update_payload(target, index.oid_field, {x: row[x] for x in list_of_update_col}))
+            id_by_oid[target[index.oid_field]] = row[id_col]
+
+    report = update_features_chunked(lyr, updates, id_by_oid, chunk_size=chunk_size, max_workers=max_workers, checkpoint=checkpoint)
+    finish_checkpoint(checkpoint, report)
+    report['missing'] = missing
+    report['duplicates'] = duplicates
+
+    print_text_log(f"{len(report['updated'])} features updated and {len(report['failed'])} failed out of {csv_df.shape[0]} features")
     print_text_log("Update completed!")
+    report['metrics'] = metrics.finish('update_all')
+    return report
+
+# item type and file extension of the formats the layer append can read
+APPEND_FORMATS = {'csv': ('CSV', '.csv'),
+                  'geojson': ('GeoJson', '.geojson'),
+                  'filegdb': ('File Geodatabase', '.zip')}
+
+
+def supports_append(layer, upload_format):
+    # check if the layer can append and upsert from an uploaded file of the format
+    formats = [x.strip().lower() for x in str(layer.properties.get('supportedAppendFormats') or '').split(',')]
+    return bool(layer.properties.get('supportsAppend')) and upload_format.lower() in formats
+
+
+def changed_rows(csv_df, index, id_col, list_of_update_col):
+    # rows which are not in the layer yet or whose values differ from the indexed ones
+    list_of_update_col = list(list_of_update_col)
+    snapshot = index.to_frame(list_of_update_col)[list_of_update_col]
+    snapshot.insert(0, '_id_key', list(index.features.keys()))
+    survey = csv_df[list_of_update_col].assign(_id_key=id_keys(csv_df[id_col]).to_numpy())
+    merged = survey.merge(snapshot, on='_id_key', how='left', suffixes=('', '_current'), indicator=True)
+    new_values = merged[list_of_update_col]
+    current_values = merged[[x + '_current' for x in list_of_update_col]].set_axis(list_of_update_col, axis=1)
+    changed = (new_values.ne(current_values) & ~(new_values.isna() & current_values.isna())).any(axis=1)
+    return csv_df[(changed | (merged['_merge'] == 'left_only')).to_numpy()]
+
+
+def write_upload_file(csv_df, folder, upload_format, columns):
+    # write the columns of the rows, and their geometry for geojson and filegdb, to one file for upload
+    # append reads geojson as WGS84 so the geometry is reprojected for it, a file geodatabase keeps its own crs
+    file_name = os.path.join(folder, 'upsert' + APPEND_FORMATS[upload_format][1])
+    if upload_format == 'csv':
+        csv_df[columns].to_csv(file_name, index=False)
+    elif upload_format == 'geojson':
+        frame = csv_df[columns + ['geometry']]
+        if frame.crs is not None and frame.crs.to_epsg() != 4326:
+            frame = frame.to_crs(4326)
+        frame.to_file(file_name, driver='GeoJSON')
+    else:
+        import shutil
+        csv_df[columns + ['geometry']].to_file(os.path.join(folder, 'upsert.gdb'), driver='OpenFileGDB', layer='upsert')
+        file_name = shutil.make_archive(os.path.join(folder, 'upsert'), 'zip', folder, 'upsert.gdb')
+    return file_name
+
+
+def append_upload(lyr, file_name, upload_format, id_col, columns, update_geometry, session):
+    # upload the file as a temporary item and upsert it into the layer with one append job
+    layer = lyr.layers[0]
+    item_properties = {'title': f"upsert {layer.properties.get('name', 'layer')} {int(time.time())}",
+                       'type': APPEND_FORMATS[upload_format][0],
+                       'tags': 'upsert'}
+    with metrics.phase('upload'):
+        upload_item = retry_policy.call('content.add', session.gis.content.add, item_properties, data=file_name)
+    try:
+        source_info = None
+        if upload_format == 'csv':
+            source_info = retry_policy.call('analyze', session.gis.content.analyze, item=upload_item, file_type='csv', location_type='none')['publishParameters']
+        with metrics.phase('append'):
+            result = retry_policy.call('append', call_with_budget, layer.append,
+                                       item_id=upload_item.id,
+                                       upload_format=upload_format,
+                                       source_info=source_info,
+                                       upsert=True,
+                                       upsert_matching_field=id_col,
+                                       update_geometry=update_geometry,
+                                       append_fields=columns,
+                                       rollback=True)
+    finally:
+        try:
+            upload_item.delete()
+        except Exception as error:
+            print_text_log(f"Uploaded item {upload_item.id} could not be deleted: {error}")
+    return bool(result[0] if isinstance(result, tuple) else result)
+
+
+def esri_spatial_reference(crs):
+    # spatialReference of a crs for edit payloads, its epsg code or else its wkt, None when the crs is unknown
+    if crs is None:
+        return None
+    epsg = crs.to_epsg()
+    if epsg is not None:
+        return {'wkid': epsg}
+    return {'wkt': crs.to_wkt(version='WKT1_ESRI')}
+
+
+def make_feature_geometry(geometry, spatial_reference=None):
+    # esri geometry of a shapely polygon for an edit payload, without a spatial reference the layer reads it in its own
+    esri_geometry = {'rings': esri_rings(geometry.__geo_interface__)}
+    if spatial_reference is not None:
+        esri_geometry['spatialReference'] = spatial_reference
+    return esri_geometry
+
+
+def send_add_chunk(layer, chunk_ids, chunk, id_col):
+    # add one chunk of features, adds are not idempotent so they are not simply sent again like the updates:
+    # a throttled chunk was refused and is sent again, after any other transient error the edit may have been applied
+    # so the ids already in the layer are looked up and only the others are sent again
+    pending = list(zip(chunk_ids, chunk))
+    added = []
+
+    def send():
+        return call_with_budget(layer.edit_features, adds=[x[1] for x in pending], rollback_on_failure=False)
+
+    def drop_added(error):
+        if is_throttle_error(error):
+            return None
+        found = {id_key(x.attributes[id_col]) for x in query_features_by_ids(layer, id_col, [x[0] for x in pending], out_fields=id_col)}
+        added.extend(x[0] for x in pending if id_key(x[0]) in found)
+        pending[:] = [x for x in pending if id_key(x[0]) not in found]
+        logger.debug(f"{len(chunk) - len(pending)} features of the chunk were added before the error")
+        return {'addResults': []} if len(pending) == 0 else None
 
-##
\ No newline at end of file
+    try:
+        result = retry_policy.call('add_features', send, before_retry=drop_added)
+    except Exception as error:
+        result = {'addResults': [], 'error': {'description': str(error)}}
+    failed = []
+    add_results = result.get('addResults', [])
+    for position, (identifier, payload) in enumerate(pending):
+        feature_result = add_results[position] if position < len(add_results) else {'success': False, 'error': result.get('error', {'description': 'no result returned'})}
+        if feature_result.get('success'):
+            added.append(identifier)
+        else:
+            failed.append({'id': identifier, 'payload': payload, 'error': feature_result.get('error')})
+    return added, failed
+
+
+def add_features_chunked(lyr, adds, identifiers, id_col, chunk_size=1000, checkpoint=None):
+    # add new features in chunks, the add results come back in the order of the features
+    added, failed = [], []
+    with metrics.phase('edit'):
+        for chunk_ids, chunk in zip(iter_chunks(identifiers, chunk_size), iter_chunks(adds, chunk_size)):
+            metrics.count('rows_sent', len(chunk))
+            metrics.count('bytes_sent', len(json.dumps(chunk, default=str)))
+            chunk_added, chunk_failed = send_add_chunk(lyr.layers[0], chunk_ids, chunk, id_col)
+            if checkpoint is not None and len(chunk_added) > 0:
+                checkpoint.record(chunk_added)
+            added.extend(chunk_added)
+            failed.extend(chunk_failed)
+    metrics.count('rows_updated', len(added))
+    metrics.count('rows_failed', len(failed))
+    return added, failed
+
+
+def upsert_with_edits(lyr, csv_df, id_col, list_of_update_col, index=None, chunk_size=1000, max_workers=1, checkpoint=None):
+    # upsert through edit_features: update the rows found in the layer and add the others
+    if index is None:
+        index = build_feature_index(lyr, id_col, list_of_update_col, identifiers=csv_df[id_col])
+    with_geometry = 'geometry' in csv_df.columns
+    spatial_reference = esri_spatial_reference(getattr(csv_df, 'crs', None)) if with_geometry else None
+    columns = [id_col] + list(list_of_update_col) + (['geometry'] if with_geometry else [])
+    updates, id_by_oid, adds, add_ids = [], {}, [], []
+    with metrics.phase('diff'):
+        for row in csv_df[columns].to_dict('records'):
+            values = {x: row[x] for x in list_of_update_col}
+            target = index.get(row[id_col])
+            if target is None:
+                payload = {'attributes': {x: to_python_value(v) for x, v in dict(values, **{id_col: row[id_col]}).items()}}
+                if with_geometry and row['geometry'] is not None:
+                    payload['geometry'] = make_feature_geometry(row['geometry'], spatial_reference)
+                adds.append(payload)
+                add_ids.append(row[id_col])
+                continue
+            payload = make_update_payload(target, index.oid_field, values)
+            if with_geometry and row['geometry'] is not None:
+                payload['geometry'] = make_feature_geometry(row['geometry'], spatial_reference)
+            updates.append(payload)
+            id_by_oid[target[index.oid_field]] = row[id_col]
+
+    report = update_features_chunked(lyr, updates, id_by_oid, chunk_size=chunk_size, max_workers=max_workers, checkpoint=checkpoint)
+    added, add_failed = add_features_chunked(lyr, adds, add_ids, id_col, chunk_size, checkpoint)
+    report['added'] = added
+    report['failed'] = report['failed'] + add_failed
+    return report
+
+
+def upsert_features(lyr, csv_df, id_col = 'Identifier', list_of_update_col = ['Name', 'Class', 'activity'], upload_format = None, index = None, chunk_size = 1000, max_workers = 1, session = None, checkpoint = None):
+    # update the rows found in the layer and add the others, matched on id_col, with one upload and one append job
+    # a GeoDataFrame is uploaded as geojson with its geometry, a DataFrame as csv, falling back to edit_features
+    # when the layer cannot append the format or the append fails; with an index only the new and changed rows are sent
+    # the append matches on id_col, which needs a unique index on that field in the layer, and does not tell updates
+    # from additions so every row sent is listed as updated; with a checkpoint the rows a crashed run applied are skipped
+    print_text_log(f"Upserting columns {str(list_of_update_col)}, and using column {id_col} for ID")
+    list_of_update_col = list(list_of_update_col)
+    session = session or get_session()
+    with_geometry = 'geometry' in csv_df.columns
+    upload_format = upload_format or ('geojson' if with_geometry else 'csv')
+    csv_df = skip_checkpointed_rows(csv_df, id_col, checkpoint)
+
+    if index is not None:
+        with metrics.phase('diff'):
+            csv_df = changed_rows(csv_df, index, id_col, list_of_update_col)
+        print_text_log(f"{csv_df.shape[0]} rows are new or changed")
+    if csv_df.shape[0] == 0:
+        report = {'method': None, 'updated': [], 'added': [], 'failed': []}
+        finish_checkpoint(checkpoint, report)
+        report['metrics'] = metrics.finish('upsert_features')
+        return report
+
+    layer = lyr.layers[0]
+    if supports_append(layer, upload_format):
+        import tempfile
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                file_name = write_upload_file(csv_df, folder, upload_format, [id_col] + list_of_update_col)
+                metrics.count('rows_sent', csv_df.shape[0])
+                metrics.count('bytes_sent', os.path.getsize(file_name))
+                appended = append_upload(lyr, file_name, upload_format, id_col, [id_col] + list_of_update_col, with_geometry, session)
+            if appended:
+                print_text_log(f"{csv_df.shape[0]} rows upserted with one append")
+                report = {'method': 'append', 'updated': csv_df[id_col].tolist(), 'added': [], 'failed': []}
+                finish_checkpoint(checkpoint, report)
+                report['metrics'] = metrics.finish('upsert_features')
+                return report
+            print_text_log("Append did not succeed, sending the rows with edit_features instead")
+        except Exception as error:
+            print_text_log(f"Append failed with {error}, sending the rows with edit_features instead")
+    else:
+        print_text_log(f"The layer cannot append {upload_format} files, sending the rows with edit_features")
+
+    report = upsert_with_edits(lyr, csv_df, id_col, list_of_update_col, index, chunk_size, max_workers, checkpoint)
+    report['method'] = 'edit_features'
+    finish_checkpoint(checkpoint, report)
+    print_text_log(f"{len(report['updated'])} features updated, {len(report['added'])} added and {len(report['failed'])} failed out of {csv_df.shape[0]} rows")
+    report['metrics'] = metrics.finish('upsert_features')
+    return report
+
+##